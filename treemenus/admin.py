@@ -1,4 +1,8 @@
 import re
+try:
+    import json
+except ImportError:  # Python < 2.6
+    from django.utils import simplejson as json
 
 import django
 try:
@@ -8,21 +12,41 @@ except ImportError:  # Django < 1.4
     from django.conf.urls.defaults import patterns, url
 from django.contrib import admin
 from django.contrib.admin.util import unquote
-from django.core.exceptions import PermissionDenied
-from django.http import HttpResponseRedirect, Http404
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseRedirect, Http404
 from django.http import HttpResponsePermanentRedirect
 from django.utils.html import escape
-from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext as _, ugettext_lazy
 try:
     from django.utils.encoding import force_text
 except ImportError:  # Django < 1.5
     from django.utils.encoding import force_unicode as force_text
 
+from treemenus.cache import batch_invalidations
 from treemenus.models import Menu, MenuItem
-from treemenus.utils import get_parent_choices, MenuItemChoiceField, move_item_or_clean_ranks
+from treemenus.utils import get_parent_choice_items, MenuItemChoiceField, move_item, reorder_menu_items
+
+
+class BatchInvalidationsMixin(object):
+    '''
+    Invalidates the menus changed by the admin's views once their transaction is committed,
+    rather than while other processes can still read and cache the old data (see
+    cache.batch_invalidations()).
+    '''
+    def add_view(self, request, *args, **kwargs):
+        return batch_invalidations(super(BatchInvalidationsMixin, self).add_view)(request, *args, **kwargs)
+
+    def change_view(self, request, *args, **kwargs):
+        return batch_invalidations(super(BatchInvalidationsMixin, self).change_view)(request, *args, **kwargs)
+
+    def delete_view(self, request, *args, **kwargs):
+        return batch_invalidations(super(BatchInvalidationsMixin, self).delete_view)(request, *args, **kwargs)
+
+    def changelist_view(self, request, *args, **kwargs):
+        return batch_invalidations(super(BatchInvalidationsMixin, self).changelist_view)(request, *args, **kwargs)
 
 
-class MenuItemAdmin(admin.ModelAdmin):
+class MenuItemAdmin(BatchInvalidationsMixin, admin.ModelAdmin):
     ''' This class is used as a proxy by MenuAdmin to manipulate menu items. It should never be registered. '''
     def __init__(self, model, admin_site, menu):
         super(MenuItemAdmin, self).__init__(model, admin_site)
@@ -70,13 +94,14 @@ class MenuItemAdmin(admin.ModelAdmin):
 
     def get_form(self, request, obj=None, **kwargs):
         form = super(MenuItemAdmin, self).get_form(request, obj, **kwargs)
-        choices = get_parent_choices(self._menu, obj)
-        form.base_fields['parent'] = MenuItemChoiceField(choices=choices)
+        items = get_parent_choice_items(self._menu, obj)
+        form.base_fields['parent'] = MenuItemChoiceField(items=items)
         return form
 
 
-class MenuAdmin(admin.ModelAdmin):
+class MenuAdmin(BatchInvalidationsMixin, admin.ModelAdmin):
     menu_item_admin_class = MenuItemAdmin
+    actions = ['clone_menus']
 
     def __call__(self, request, url):
         ''' DEPRECATED!! More recent versions of Django use the get_urls method instead.
@@ -87,6 +112,9 @@ class MenuAdmin(admin.ModelAdmin):
                 return self.add_menu_item(request, unquote(url[:-10]))
             if url.endswith('items'):
                 return HttpResponseRedirect('../')
+            match = re.match('^(?P<menu_pk>[-\w]+)/items/reorder$', url)
+            if match:
+                return self.reorder_items(request, match.group('menu_pk'))
             match = re.match('^(?P<menu_pk>[-\w]+)/items/(?P<menu_item_pk>[-\w]+)$', url)
             if match:
                 return self.edit_menu_item(request, match.group('menu_pk'), match.group('menu_item_pk'))
@@ -109,6 +137,8 @@ class MenuAdmin(admin.ModelAdmin):
         my_urls = patterns('',
                            (r'^(?P<menu_pk>[-\w]+)/items/add/$',
                             self.admin_site.admin_view(self.add_menu_item)),
+                           (r'^(?P<menu_pk>[-\w]+)/items/reorder/$',
+                            self.admin_site.admin_view(self.reorder_items)),
                            (r'^(?P<menu_pk>[-\w]+)/items/(?P<menu_item_pk>[-\w]+)/$',
                             self.admin_site.admin_view(self.edit_menu_item)),
                            (r'^(?P<menu_pk>[-\w]+)/items/(?P<menu_item_pk>[-\w]+)/delete/$',
@@ -145,6 +175,52 @@ class MenuAdmin(admin.ModelAdmin):
                                 )
         return my_urls + urls
 
+    def render_change_form(self, request, context, *args, **kwargs):
+        obj = kwargs.get('obj')
+        if obj is not None:
+            context['menu_items'] = self.get_menu_item_rows(obj)
+        return super(MenuAdmin, self).render_change_form(request, context, *args, **kwargs)
+
+    def get_menu_item_rows(self, menu):
+        ''' Returns the menu's items in display order, annotated with everything the
+            change form needs to list them, so that the template doesn't hit the DB.
+        '''
+        root_item = menu.get_tree()
+        if root_item is None:
+            return []
+        rows = []
+        pending = [(root_item, 0, 1)]
+        while pending:
+            menu_item, position, sibling_total = pending.pop()
+            menu_item.sibling_count = sibling_total - 1
+            menu_item.is_first = position == 0
+            menu_item.is_last = position == sibling_total - 1
+            rows.append(menu_item)
+            children = menu_item.children()
+            pending.extend((children[i], i, len(children)) for i in reversed(range(len(children))))
+        return rows
+
+    def clone_menus(self, request, queryset):
+        ''' Admin action creating a copy of each selected menu, along with its items '''
+        taken_names = set(Menu.objects.values_list('name', flat=True))
+        for menu in queryset:
+            name = self.get_copy_name(menu.name, taken_names)
+            menu.clone(name=name)
+            taken_names.add(name)
+        self.message_user(request, _('%s menu(s) were cloned successfully.') % len(queryset))
+    clone_menus.short_description = ugettext_lazy('Clone selected menus')
+
+    def get_copy_name(self, name, taken_names):
+        ''' Returns a name for a copy of the menu named 'name', which isn't one of 'taken_names' '''
+        max_length = Menu._meta.get_field('name').max_length
+        number = 1
+        while True:
+            label = _('%s (copy)') if number == 1 else _('%%s (copy %s)') % number
+            copy_name = label % name[:max_length - len(label % '')]
+            if copy_name not in taken_names:
+                return copy_name
+            number += 1
+
     def get_object_with_change_permissions(self, request, model, obj_pk):
         ''' Helper function that returns a menu/menuitem if it exists and if the user has the change permissions '''
         try:
@@ -193,10 +269,10 @@ class MenuAdmin(admin.ModelAdmin):
         self.get_object_with_change_permissions(request, Menu, menu_pk)
         menu_item = self.get_object_with_change_permissions(request, MenuItem, menu_item_pk)
 
-        if menu_item.rank < menu_item.siblings().count():
-            move_item_or_clean_ranks(menu_item, 1)
+        try:
+            move_item(menu_item, 1)
             msg = _('The menu item "%s" was moved successfully.') % force_text(menu_item)
-        else:
+        except MenuItem.DoesNotExist:
             msg = _('The menu item "%s" is not allowed to move down.') % force_text(menu_item)
 
         if django.VERSION >= (1, 4):
@@ -210,10 +286,10 @@ class MenuAdmin(admin.ModelAdmin):
         self.get_object_with_change_permissions(request, Menu, menu_pk)
         menu_item = self.get_object_with_change_permissions(request, MenuItem, menu_item_pk)
 
-        if menu_item.rank > 0:
-            move_item_or_clean_ranks(menu_item, -1)
+        try:
+            move_item(menu_item, -1)
             msg = _('The menu item "%s" was moved successfully.') % force_text(menu_item)
-        else:
+        except MenuItem.DoesNotExist:
             msg = _('The menu item "%s" is not allowed to move up.') % force_text(menu_item)
 
         if django.VERSION >= (1, 4):
@@ -223,5 +299,23 @@ class MenuAdmin(admin.ModelAdmin):
 
         return HttpResponseRedirect('../../../')
 
+    def reorder_items(self, request, menu_pk):
+        ''' Custom view applying a new arrangement of the menu's items, posted as a JSON list
+            of {"id": ..., "parent": ..., "rank": ...} objects (see reorder_menu_items()).
+        '''
+        menu = self.get_object_with_change_permissions(request, Menu, menu_pk)
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        body = request.body if hasattr(request, 'body') else request.raw_post_data  # Django < 1.4
+        try:
+            reorder_menu_items(menu, json.loads(force_text(body)))
+        except ValueError:
+            errors = [_('The posted data is not valid JSON.')]
+        except ValidationError as e:
+            errors = e.messages
+        else:
+            return HttpResponse(json.dumps({'status': 'ok'}), content_type='application/json')
+        return HttpResponseBadRequest(json.dumps({'status': 'error', 'errors': errors}), content_type='application/json')
+
 
 admin.site.register(Menu, MenuAdmin)
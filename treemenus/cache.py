@@ -0,0 +1,490 @@
+import hashlib
+import threading
+import time
+
+try:
+    from collections import OrderedDict
+except ImportError:  # Python < 2.7
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+try:
+    from django.utils.encoding import force_text
+except ImportError:  # Django < 1.5
+    from django.utils.encoding import force_unicode as force_text
+
+
+class LocalTreeCache(object):
+    '''
+    Thread-safe, size-bounded cache evicting the least recently used entries first.
+    '''
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return None
+            self._entries[key] = value  # Move it back to the most recently used end.
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        max_size = getattr(settings, 'TREEMENUS_LOCAL_CACHE_SIZE', 100)
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > max_size:
+                del self._entries[next(iter(self._entries))]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+local_cache = LocalTreeCache()
+
+_versions = {}
+_generation = [0]  # Bumped when a change can't be attributed to a particular menu.
+_versions_lock = threading.Lock()
+# Invalidations made by the current thread within batch_invalidations().
+_batched = threading.local()
+
+# Primary key and root item of menus, by name. See get_menu_by_name().
+_menu_names = {}
+
+GENERATION_KEY = 'treemenus:generation'
+NAMES_KEY = 'treemenus:names'
+VERSION_KEY = 'treemenus:version:%s'
+TREE_KEY = 'treemenus:tree:%s:%s.%s:%s'
+FRAGMENT_KEY = 'treemenus:fragment:%s:%s.%s:%s'
+URLS_KEY = 'treemenus:urls:%s:%s.%s:%s'
+
+
+def get_cache_tiers():
+    '''
+    Returns a (local, shared) pair of booleans telling which cache tiers are enabled
+    by the TREEMENUS_CACHE setting: 'local', 'shared', 'both' or None.
+    '''
+    setting = getattr(settings, 'TREEMENUS_CACHE', None)
+    if setting not in (None, 'local', 'shared', 'both'):
+        raise ImproperlyConfigured("The TREEMENUS_CACHE setting must be one of None, 'local', 'shared' or 'both'.")
+    return setting in ('local', 'both'), setting in ('shared', 'both')
+
+
+def get_cache_timeout():
+    '''
+    Returns the number of seconds trees and fragments are kept in the Django cache, given by
+    the TREEMENUS_CACHE_TIMEOUT setting: one hour by default, None meaning forever.
+    '''
+    return getattr(settings, 'TREEMENUS_CACHE_TIMEOUT', 3600)
+
+
+def get_shared_cache():
+    ''' Returns the Django cache selected by the TREEMENUS_CACHE_ALIAS setting. '''
+    alias = getattr(settings, 'TREEMENUS_CACHE_ALIAS', 'default')
+    try:
+        from django.core.cache import caches
+    except ImportError:  # Django < 1.7
+        from django.core.cache import get_cache
+        return get_cache(alias)
+    return caches[alias]
+
+
+def _get_shared_stamps(shared_cache, keys):
+    stamps = shared_cache.get_many(keys)
+    for key in keys:
+        if key not in stamps:
+            # Start from the current time rather than from 0, so that trees cached under
+            # a stamp that has since been evicted can never be mistaken for fresh ones.
+            shared_cache.add(key, int(time.time() * 1000), None)
+            stamps[key] = shared_cache.get(key)
+    return stamps
+
+
+def uses_shared_stamps():
+    ''' Returns True if the menu version stamps need to be kept in the Django cache. '''
+    return get_cache_tiers()[1] or getattr(settings, 'TREEMENUS_FRAGMENT_CACHE', False)
+
+
+def get_menu_version(menu_pk, shared=None):
+    '''
+    Returns a stamp that changes every time the given menu or one of its items is modified.
+    When the stamps are shared (see uses_shared_stamps()), the stamp is kept in the Django
+    cache so that all processes agree on it, and locally cached entries are checked against it
+    too: otherwise a process could cache fragments rendered from its stale trees under the new
+    stamp of a menu changed by another process.
+    '''
+    return get_menu_versions([menu_pk], shared)[menu_pk]
+
+
+def get_menu_versions(menu_pks, shared=None):
+    ''' Returns the stamps of the given menus (see get_menu_version()), by pk, in one cache lookup. '''
+    if shared is None:
+        shared = uses_shared_stamps()
+    if shared:
+        keys = [VERSION_KEY % menu_pk for menu_pk in menu_pks]
+        stamps = _get_shared_stamps(get_shared_cache(), [GENERATION_KEY] + keys)
+        return dict((menu_pk, (stamps[GENERATION_KEY], stamps[key])) for menu_pk, key in zip(menu_pks, keys))
+    return dict((menu_pk, (_generation[0], _versions.get(menu_pk, 0))) for menu_pk in menu_pks)
+
+
+def invalidate_menu(menu_pk):
+    ''' Marks every tree cached for the given menu as stale. Passing None invalidates all menus. '''
+    _invalidate(_invalidate_menu, menu_pk)
+
+
+def invalidate_menu_names():
+    ''' Forgets the menus found by name (see get_menu_by_name()), in all processes. '''
+    _invalidate(_invalidate_menu_names)
+
+
+def _invalidate(func, *args):
+    pending = getattr(_batched, 'pending', None)
+    if pending is not None:
+        pending.add((func,) + args)
+        return
+    func(*args)
+    on_commit = getattr(transaction, 'on_commit', None)  # Django >= 1.9
+    if on_commit is not None and transaction.get_connection().in_atomic_block:
+        # Until the change is committed, other processes still read the old data, and may
+        # cache it under the new stamp: bump it again once they can see the change.
+        on_commit(lambda: func(*args))
+
+
+def _invalidate_menu(menu_pk):
+    _versions_lock.acquire()
+    try:
+        if menu_pk is None:
+            _generation[0] += 1
+        else:
+            _versions[menu_pk] = _versions.get(menu_pk, 0) + 1
+    finally:
+        _versions_lock.release()
+
+    if uses_shared_stamps():
+        key = GENERATION_KEY if menu_pk is None else VERSION_KEY % menu_pk
+        shared_cache = get_shared_cache()
+        try:
+            shared_cache.incr(key)
+        except ValueError:  # Not set yet (or evicted), so nothing can be cached under it.
+            pass
+
+
+def _invalidate_menu_names():
+    _menu_names.clear()
+    if uses_shared_stamps():
+        try:
+            get_shared_cache().incr(NAMES_KEY)
+        except ValueError:  # Not set yet (or evicted), so no name can have been cached under it.
+            pass
+
+
+def batch_invalidations(func):
+    '''
+    Wraps 'func' so that the menus it invalidates, e.g. through the signals sent for each item
+    of a deleted queryset, only get invalidated once each, when it returns. Wrapping a function
+    that runs a transaction thus invalidates the menus once the changes are committed, rather
+    than while other processes can still read and cache the old data.
+    '''
+    def wrapper(*args, **kwargs):
+        if getattr(_batched, 'pending', None) is not None:  # Already batching
+            return func(*args, **kwargs)
+        _batched.pending = set()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            pending, _batched.pending = _batched.pending, None
+            for call in pending:
+                _invalidate(*call)
+    return wrapper
+
+
+def serialize_tree(menu):
+    '''
+    Returns a compact, picklable representation of the given menu and of its loaded tree:
+    plain tuples of field values, with the items listed in rank order, followed by the
+    values of their extension objects.
+    '''
+    from treemenus.models import MenuItem
+    from treemenus.utils import get_menu_item_extension_relations
+    item_fields = [field.attname for field in MenuItem._meta.fields]
+    menu_items = []
+    pending = [menu.root_item]
+    while pending:
+        menu_item = pending.pop()
+        menu_items.append(menu_item)
+        pending.extend(reversed(menu_item.children()))
+    items = [tuple(getattr(menu_item, attname) for attname in item_fields) for menu_item in menu_items]
+    items.sort(key=lambda values: values[item_fields.index('rank')])
+
+    extensions = []
+    for related in get_menu_item_extension_relations():
+        extension_fields = [field.attname for field in related.model._meta.fields]
+        rows = []
+        for menu_item in menu_items:
+            extension = getattr(menu_item, related.get_cache_name(), None)
+            if extension is not None:
+                rows.append(tuple(getattr(extension, attname) for attname in extension_fields))
+        extensions.append((related.get_accessor_name(), extension_fields, rows))
+    return (menu.pk, menu.name, menu.root_item_id, item_fields, items, extensions)
+
+
+def deserialize_tree(data):
+    ''' Rebuilds a menu and its tree from the output of serialize_tree(). '''
+    from treemenus.models import Menu, MenuItem, build_tree
+    from treemenus.utils import get_menu_item_extension_relations, resolve_named_urls, set_menu_item_extensions
+    menu_pk, name, root_item_id, item_fields, items, extensions = data
+    menu = Menu(pk=menu_pk, name=name, root_item_id=root_item_id)
+    menu._state.adding = False
+    menu_items = []
+    for values in items:
+        menu_item = MenuItem(**dict(zip(item_fields, values)))
+        menu_item._state.adding = False
+        menu_items.append(menu_item)
+    menu.root_item = build_tree(menu_items, root_item_id)
+    resolve_named_urls(menu_items)
+
+    relations = dict((related.get_accessor_name(), related) for related in get_menu_item_extension_relations())
+    for accessor_name, extension_fields, rows in extensions:
+        related = relations.get(accessor_name)
+        if related is None:  # No longer an extension
+            continue
+        extension_objects = []
+        for values in rows:
+            extension = related.model(**dict(zip(extension_fields, values)))
+            extension._state.adding = False
+            extension_objects.append(extension)
+        set_menu_item_extensions(menu_items, related, extension_objects)
+    return menu
+
+
+def get_menu_tree(menu, item_filter=None):
+    '''
+    Returns the given menu with its whole tree of items loaded (see Menu.get_tree()), only
+    keeping the items matching 'item_filter' if given (see utils.get_menu_item_filter()).
+    Depending on the TREEMENUS_CACHE setting, trees are kept in a process-local cache,
+    in the Django cache shared by all processes, or in both, until the menu or one of
+    its items is saved or deleted. Filtered trees are cached separately for each filter.
+    '''
+    return get_menu_trees([menu], item_filter)[0]
+
+
+def get_menu_trees(menus, item_filter=None):
+    '''
+    Same as get_menu_tree(), for several menus at once: returns the given menus with their
+    trees loaded, the ones that aren't cached being loaded together with a single query, and
+    the shared cache being read with a single get_many().
+    '''
+    from treemenus.models import load_trees
+    menus = list(menus)
+    use_local, use_shared = get_cache_tiers()
+    if not (use_local or use_shared):
+        load_trees(menus, _get_item_filter(item_filter))
+        return menus
+
+    # Read the versions before loading, so that a concurrent change is never missed.
+    versions = get_menu_versions([menu.pk for menu in menus])
+    local_keys = dict((menu.pk, menu.pk if item_filter is None else (menu.pk, item_filter)) for menu in menus)
+    cached_menus = {}
+    if use_local:
+        for menu in menus:
+            entry = local_cache.get(local_keys[menu.pk])
+            if entry is not None and entry[0] == versions[menu.pk]:
+                cached_menus[menu.pk] = entry[1]
+
+    missing_menus = [menu for menu in menus if menu.pk not in cached_menus]
+    if use_shared and missing_menus:
+        shared_cache = get_shared_cache()
+        filter_digest = item_filter is not None and hashlib.md5(force_text(item_filter).encode('utf-8')).hexdigest() or ''
+        tree_keys = dict((menu.pk, TREE_KEY % ((menu.pk,) + versions[menu.pk] + (filter_digest,))) for menu in missing_menus)
+        for data in shared_cache.get_many(list(tree_keys.values())).values():
+            cached_menu = deserialize_tree(data)
+            cached_menus[cached_menu.pk] = cached_menu
+            if use_local:
+                local_cache.set(local_keys[cached_menu.pk], (versions[cached_menu.pk], cached_menu))
+
+    missing_menus = [menu for menu in missing_menus if menu.pk not in cached_menus]
+    if missing_menus:
+        load_trees(missing_menus, _get_item_filter(item_filter))
+        for menu in missing_menus:
+            cached_menus[menu.pk] = menu
+            if use_shared:
+                shared_cache.set(tree_keys[menu.pk], serialize_tree(menu), get_cache_timeout())
+            if use_local:
+                local_cache.set(local_keys[menu.pk], (versions[menu.pk], menu))
+    return [cached_menus[menu.pk] for menu in menus]
+
+
+def get_menu_window(menu, start_level=1, max_depth=None, active_path=None, expand=False, item_filter=None):
+    '''
+    Returns a copy of the given menu with only part of its tree loaded (see
+    models.load_tree_window()), or None if that part is empty. Windows are cached like whole
+    trees (see get_menu_tree()), separately for each window, filter and active path.
+    '''
+    from treemenus.models import Menu, load_tree_window
+    window = (start_level, max_depth, active_path, expand)
+    use_local, use_shared = get_cache_tiers()
+    if use_local or use_shared:
+        version = get_menu_version(menu.pk)
+        local_key = (menu.pk, item_filter, window)
+        if use_local:
+            entry = local_cache.get(local_key)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+        if use_shared:
+            shared_cache = get_shared_cache()
+            digest = hashlib.md5(force_text((item_filter, window)).encode('utf-8')).hexdigest()
+            tree_key = TREE_KEY % ((menu.pk,) + version + (digest,))
+            data = shared_cache.get(tree_key)
+            if data is not None:
+                window_menu = deserialize_tree(data)
+                if use_local:
+                    local_cache.set(local_key, (version, window_menu))
+                return window_menu
+
+    window_menu = Menu(pk=menu.pk, name=menu.name, root_item_id=menu.root_item_id)
+    window_menu._state.adding = False
+    if load_tree_window(window_menu, start_level, max_depth, active_path, expand, _get_item_filter(item_filter)) is None:
+        return None
+    if use_shared:
+        shared_cache.set(tree_key, serialize_tree(window_menu), get_cache_timeout())
+    if use_local:
+        local_cache.set(local_key, (version, window_menu))
+    return window_menu
+
+
+def get_menu_url_paths(menu):
+    '''
+    Returns the paths of the given menu's items by normalized URL (see utils.get_url_paths()),
+    cached like trees, for each URLconf, script prefix and language, until the menu changes.
+    '''
+    from django.core.urlresolvers import get_script_prefix, get_urlconf
+    from django.utils.translation import get_language
+    from treemenus.utils import get_url_paths
+    use_local, use_shared = get_cache_tiers()
+    if not (use_local or use_shared):
+        return get_url_paths(menu)
+    version = get_menu_version(menu.pk)
+    local_key = ('urls', menu.pk, get_urlconf(), get_script_prefix(), get_language())
+    if use_local:
+        entry = local_cache.get(local_key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+    if use_shared:
+        shared_cache = get_shared_cache()
+        digest = hashlib.md5(force_text(local_key).encode('utf-8')).hexdigest()
+        urls_key = URLS_KEY % ((menu.pk,) + version + (digest,))
+        url_paths = shared_cache.get(urls_key)
+    else:
+        url_paths = None
+    if url_paths is None:
+        url_paths = get_url_paths(menu)
+        if use_shared:
+            shared_cache.set(urls_key, url_paths, get_cache_timeout())
+    if use_local:
+        local_cache.set(local_key, (version, url_paths))
+    return url_paths
+
+
+def _get_item_filter(item_filter):
+    if item_filter is None:
+        return None
+    from treemenus.utils import get_menu_item_filter
+    return get_menu_item_filter(item_filter)
+
+
+def get_fragment_cache_key(menu_pk, *vary_on):
+    '''
+    Returns the key under which the HTML rendered for the given menu is cached. The key
+    carries the menu's shared version stamp, so it changes as soon as the menu is modified.
+    '''
+    digest = hashlib.md5(':'.join(force_text(value) for value in vary_on).encode('utf-8')).hexdigest()
+    return FRAGMENT_KEY % ((menu_pk,) + get_menu_version(menu_pk, shared=True) + (digest,))
+
+
+def get_menu_by_name(name):
+    '''
+    Returns a copy of the menu with the given name, carrying its pk and root item, or raises
+    Menu.DoesNotExist. When the version stamps are shared (see uses_shared_stamps()), names are
+    resolved from a map kept in memory after the first lookup, until a menu is saved or deleted
+    in any process, so this doesn't hit the database. Otherwise, a change made by another process
+    couldn't be noticed, so the name is looked up in the database every time.
+    '''
+    from treemenus.models import Menu
+    menus = get_menus_by_name([name])
+    if name not in menus:
+        raise Menu.DoesNotExist('There is no menu named "%s".' % name)
+    return menus[name]
+
+
+def get_menus_by_name(names):
+    '''
+    Same as get_menu_by_name(), for several names at once: returns the menus found, by name,
+    looking up the names that aren't known yet with a single query.
+    '''
+    from treemenus.models import Menu
+    if uses_shared_stamps():
+        stamp = _get_shared_stamps(get_shared_cache(), [NAMES_KEY])[NAMES_KEY]
+        menu_names = _menu_names
+    else:
+        stamp = None
+        menu_names = {}
+    missing_names = [name for name in names if name not in menu_names or menu_names[name][0] != stamp]
+    if missing_names:
+        for name, menu_pk, root_item_id in Menu.objects.filter(name__in=missing_names).values_list('name', 'pk', 'root_item'):
+            menu_names[name] = (stamp, menu_pk, root_item_id)
+
+    menus = {}
+    for name in names:
+        entry = menu_names.get(name)
+        if entry is not None and entry[0] == stamp:
+            menu = menus[name] = Menu(pk=entry[1], name=name, root_item_id=entry[2])
+            menu._state.adding = False
+    return menus
+
+
+def get_named_menu_trees(names, item_filter=None):
+    '''
+    Returns the menus with the given names, by name, with their trees loaded (see
+    get_menu_trees()), in a constant number of queries. Unknown names are left out.
+    '''
+    menus = get_menus_by_name(names)
+    return dict((menu.name, menu) for menu in get_menu_trees(list(menus.values()), item_filter))
+
+
+def menu_item_changed(sender, instance, **kwargs):
+    ''' Signal handler invalidating cached trees when a menu item is saved or deleted. '''
+    invalidate_menu(instance.menu_id)
+
+
+def menu_item_extension_changed(sender, instance, **kwargs):
+    ''' Signal handler invalidating cached trees when a menu item extension is saved or deleted. '''
+    from treemenus.models import MenuItem
+    from treemenus.utils import get_menu_item_extension_relations
+    if sender not in [related.model for related in get_menu_item_extension_relations()]:
+        return
+    for menu_pk in MenuItem.objects.filter(pk=instance.menu_item_id).values_list('menu', flat=True):
+        invalidate_menu(menu_pk)
+
+
+def menu_changed(sender, instance, **kwargs):
+    ''' Signal handler invalidating cached trees and menu names when a menu is saved or deleted. '''
+    invalidate_menu(instance.pk)
+    invalidate_menu_names()
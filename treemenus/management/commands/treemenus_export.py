@@ -0,0 +1,79 @@
+from optparse import make_option
+try:
+    import json
+except ImportError:  # Python < 2.6
+    from django.utils import simplejson as json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from treemenus.models import Menu, PATH_SEGMENT_FORMAT, PATH_SEPARATOR
+from treemenus.utils import MENU_ITEM_DATA_FIELDS
+
+
+class Command(BaseCommand):
+    args = '[menu_name ...]'
+    help = ('Exports menus (all of them by default) as JSON: a list of {"name": ..., "items": [...]} objects, '
+            'each item having its "children". With --format=jsonl, writes one item per line instead, '
+            'with its "menu" and its "path" within the menu.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='json', choices=['json', 'jsonl'],
+                    help='Output format: json (the default) or jsonl.'),
+        make_option('-o', '--output', dest='output', default=None,
+                    help='File to write to, instead of the standard output.'),
+    )
+
+    def handle(self, *menu_names, **options):
+        menus = Menu.objects.order_by('name')
+        if menu_names:
+            menus = menus.filter(name__in=menu_names)
+            missing_names = set(menu_names) - set(menu.name for menu in menus)
+            if missing_names:
+                raise CommandError('Unknown menus: %s' % ', '.join(sorted(missing_names)))
+
+        output = open(options['output'], 'w') if options['output'] else self.stdout
+        try:
+            if options['format'] == 'jsonl':
+                for menu in menus:
+                    for data in self.iter_items(menu):
+                        output.write(json.dumps(data) + '\n')
+            else:
+                # Menus are written one at a time, so that only one tree is held in memory
+                output.write('[\n')
+                previous = None
+                for menu in menus:
+                    if previous is not None:
+                        output.write(previous + ',\n')
+                    previous = json.dumps(self.get_menu_data(menu))
+                if previous is not None:
+                    output.write(previous + '\n')
+                output.write(']\n')
+        finally:
+            if output is not self.stdout:
+                output.close()
+
+    def get_item_data(self, menu_item):
+        return dict((field_name, getattr(menu_item, field_name)) for field_name in MENU_ITEM_DATA_FIELDS)
+
+    def get_menu_data(self, menu):
+        items = []
+        pending = [(child, items) for child in reversed(menu.get_tree().children())]
+        while pending:
+            menu_item, siblings = pending.pop()
+            data = self.get_item_data(menu_item)
+            data['children'] = []
+            siblings.append(data)
+            pending.extend((child, data['children']) for child in reversed(menu_item.children()))
+        return {'name': menu.name, 'items': items}
+
+    def iter_items(self, menu):
+        ''' Yields the menu's items in display order, with paths computed from their position. '''
+        pending = [(child, PATH_SEGMENT_FORMAT % rank)
+                   for rank, child in reversed(list(enumerate(menu.get_tree().children())))]
+        while pending:
+            menu_item, path = pending.pop()
+            data = self.get_item_data(menu_item)
+            data['menu'] = menu.name
+            data['path'] = path
+            yield data
+            pending.extend((child, '%s%s%s' % (path, PATH_SEPARATOR, PATH_SEGMENT_FORMAT % rank))
+                           for rank, child in reversed(list(enumerate(menu_item.children()))))
@@ -0,0 +1,168 @@
+from optparse import make_option
+import sys
+try:
+    import json
+except ImportError:  # Python < 2.6
+    from django.utils import simplejson as json
+
+from django.core.management.base import BaseCommand, CommandError
+try:
+    from django.db.transaction import atomic
+except ImportError:  # Django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+
+from treemenus.cache import batch_invalidations, invalidate_menu
+from treemenus.models import Menu, MenuItem, PATH_SEPARATOR
+from treemenus.utils import MENU_ITEM_DATA_FIELDS, bulk_create_menu_items, update_menu_items
+
+
+class Command(BaseCommand):
+    read_size = 65536
+    args = '<file>'
+    help = ('Imports menus exported by the treemenus_export command, from a file or from the standard input '
+            '("-"). Missing menus are created. Existing ones have all their items replaced by default, '
+            'or with --mode=merge, get the imported items that they lack, items being matched by caption and URL '
+            'among the children of each item. Everything is imported in a single transaction, one menu at a time.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None, choices=['json', 'jsonl'],
+                    help='Input format: json or jsonl. Guessed from the file name by default.'),
+        make_option('--mode', dest='mode', default='replace', choices=['replace', 'merge'],
+                    help='What to do with existing menus: replace (the default) or merge.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Expected a single file name, or "-" for the standard input.')
+        file_name = args[0]
+        input_format = options['format'] or ('jsonl' if file_name.endswith('.jsonl') else 'json')
+
+        input = sys.stdin if file_name == '-' else open(file_name)
+        try:
+            if input_format == 'jsonl':
+                menus = self.read_items(input)
+            else:
+                menus = self.read_menus(input)
+            # Deleted items each send a signal invalidating their menu: invalidate each menu only
+            # once, after the transaction is committed, so that no other process can cache the
+            # old items under the new version stamp.
+            batch_invalidations(atomic(self.import_menus))(menus, options['mode'], int(options.get('verbosity', 1)))
+        except (ValueError, KeyError, TypeError) as e:
+            raise CommandError('Invalid menu data: %s' % e)
+        finally:
+            if input is not sys.stdin:
+                input.close()
+
+    def read_menus(self, input):
+        '''
+        Yields the menus of a JSON list one at a time, each one being decoded as soon as it has
+        been read, so that only one menu is held in memory.
+        '''
+        decoder = json.JSONDecoder()
+        buffer, position = '', 0
+        delimiters, menu_expected = '[', False
+        error = None
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            char = buffer[position:position + 1]
+            if char and char in delimiters:
+                if char == ']':
+                    return
+                position += 1
+                delimiters, menu_expected = (']' if char == '[' else ''), True
+                continue
+            if char and menu_expected:
+                try:
+                    menu_data, position = decoder.raw_decode(buffer, position)
+                except ValueError as e:  # The menu may not have been read entirely yet
+                    error = e
+                else:
+                    yield menu_data
+                    delimiters, menu_expected, error = ',]', False, None
+                    continue
+            elif char:
+                raise ValueError('expected "%s" at "%s"' % ('" or "'.join(delimiters), buffer[position:position + 20]))
+            # Reading at least as much as is left in the buffer keeps retried decodings linear
+            chunk = input.read(max(self.read_size, len(buffer) - position))
+            if not chunk:
+                raise error or ValueError('unexpected end of data')
+            buffer, position = buffer[position:] + chunk, 0
+
+    def read_items(self, lines):
+        '''
+        Rebuilds the menus' trees from items listed one per line, parents first, yielding each
+        menu once all its items have been read. A menu's items must be on consecutive lines.
+        '''
+        menu_data = None
+        menu_items = {}
+        read_names = set()
+        for line in lines:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            menu_name = data.pop('menu')
+            if menu_data is None or menu_name != menu_data['name']:
+                if menu_name in read_names:
+                    raise ValueError('the items of menu "%s" are not on consecutive lines' % menu_name)
+                if menu_data is not None:
+                    yield menu_data
+                read_names.add(menu_name)
+                menu_data = {'name': menu_name, 'items': []}
+                menu_items = {'': {'children': menu_data['items']}}
+            path = data.pop('path')
+            data['children'] = []
+            menu_items[path.rpartition(PATH_SEPARATOR)[0]]['children'].append(data)
+            menu_items[path] = data
+        if menu_data is not None:
+            yield menu_data
+
+    def import_menus(self, menus, mode, verbosity):
+        for menu_data in menus:
+            self.import_menu(menu_data, mode, verbosity)
+
+    def import_menu(self, menu_data, mode, verbosity):
+        menu = list(Menu.objects.filter(name=menu_data['name'])[:1])
+        menu = menu[0] if menu else Menu.objects.create(name=menu_data['name'])
+        if mode == 'replace':
+            MenuItem.objects.filter(menu=menu).exclude(pk=menu.root_item_id).delete()
+            nodes = self.get_nodes(menu.root_item, menu_data['items'])
+            updated = 0
+        else:
+            nodes, updated = self.merge(menu.get_tree(), menu_data['items'])
+        created = bulk_create_menu_items(nodes)
+        invalidate_menu(menu.pk)
+        if verbosity >= 1:
+            self.stdout.write('Imported menu "%s": %s items created, %s updated.\n' % (menu.name, len(created), updated))
+
+    def get_nodes(self, parent, items_data):
+        ''' Returns the (menu_item, children) pairs expected by bulk_create_menu_items(). '''
+        nodes = []
+        for data in items_data:
+            menu_item = MenuItem(**dict((field_name, data.get(field_name, '')) for field_name in MENU_ITEM_DATA_FIELDS))
+            menu_item.parent = parent
+            nodes.append((menu_item, self.get_nodes(None, data['children'])))
+        return nodes
+
+    def merge(self, root_item, items_data):
+        '''
+        Returns the nodes to create for the imported items missing from the given tree, after
+        updating the other fields of the ones found in it.
+        '''
+        nodes = []
+        updates = {}
+        other_fields = [field_name for field_name in MENU_ITEM_DATA_FIELDS if field_name not in ('caption', 'url')]
+        pending = [(root_item, items_data)]
+        while pending:
+            parent, children_data = pending.pop()
+            existing_children = dict(((child.caption, child.url), child) for child in parent.children())
+            for data in children_data:
+                menu_item = existing_children.get((data['caption'], data.get('url', '')))
+                if menu_item is None:
+                    nodes.extend(self.get_nodes(parent, [data]))
+                    continue
+                values = tuple(data.get(field_name, '') for field_name in other_fields)
+                if values != tuple(getattr(menu_item, field_name) for field_name in other_fields):
+                    updates[menu_item.pk] = values
+                pending.append((menu_item, data['children']))
+        update_menu_items(other_fields, updates)
+        return nodes, len(updates)
@@ -0,0 +1,24 @@
+from django.core.management.base import NoArgsCommand
+
+from treemenus.cache import invalidate_menu
+from treemenus.models import Menu, MenuItem
+from treemenus.utils import update_descendants, update_menu_items
+
+
+class Command(NoArgsCommand):
+    help = ("Recomputes the level and path of all menu items, and sets their menu, e.g. after upgrading "
+            "from a version that didn't store them.")
+
+    def handle_noargs(self, **options):
+        root_items = list(MenuItem.objects.filter(parent__isnull=True))
+        menu_pks = dict(Menu.objects.values_list('root_item', 'pk'))
+        for root_item in root_items:
+            root_item.level, root_item.path = 0, root_item.get_path()
+            root_item.menu_id = menu_pks.get(root_item.pk, root_item.menu_id)
+        update_menu_items(('level', 'path', 'menu'), dict(
+            (root_item.pk, (root_item.level, root_item.path, root_item.menu_id)) for root_item in root_items))
+        for root_item in root_items:
+            update_descendants(root_item)
+        invalidate_menu(None)
+        if int(options.get('verbosity', 1)) >= 1:
+            self.stdout.write('Rebuilt %s menu trees.\n' % len(root_items))
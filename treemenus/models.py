@@ -1,9 +1,26 @@
+import threading
 from itertools import chain
 
+import django
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import NoReverseMatch
 from django.db import models
+from django.db.models import Q
+from django.db.models.signals import class_prepared, post_save, post_delete
 from django.utils.translation import ugettext, ugettext_lazy as _
 
 
+PATH_SEGMENT_FORMAT = '%04d'
+PATH_SEPARATOR = '.'
+PATH_MAX_LENGTH = 255
+# Beyond these, paths would no longer sort in display order or fit in the path column.
+PATH_MAX_RANK = 9999
+PATH_MAX_LEVEL = (PATH_MAX_LENGTH + len(PATH_SEPARATOR)) // len(PATH_SEGMENT_FORMAT % 0 + PATH_SEPARATOR) - 1
+
+# Item matching the page being displayed by the current thread, and the pks of its ancestors.
+_active_items = threading.local()
+
+
 class MenuItem(models.Model):
     parent = models.ForeignKey('self', verbose_name=_('parent'), null=True, blank=True)
     caption = models.CharField(_('caption'), max_length=50)
@@ -12,6 +29,15 @@ class MenuItem(models.Model):
     level = models.IntegerField(_('level'), default=0, editable=False)
     rank = models.IntegerField(_('rank'), default=0, editable=False)
     menu = models.ForeignKey('Menu', related_name='contained_items', verbose_name=_('menu'), null=True, blank=True, editable=False)
+    path = models.CharField(_('path'), max_length=PATH_MAX_LENGTH, blank=True, db_index=True, editable=False)
+
+    # Children of this item, in rank order, when it has been loaded as part of a whole tree.
+    _tree_children = None
+
+    class Meta:
+        if django.VERSION >= (1, 5):
+            # For loading whole menus and siblings in rank order
+            index_together = [['menu', 'parent', 'rank'], ['parent', 'rank']]
 
     def __str__(self):
         return self.caption
@@ -19,90 +45,183 @@ class MenuItem(models.Model):
     def __unicode__(self):
         return self.caption
 
+    def __init__(self, *args, **kwargs):
+        super(MenuItem, self).__init__(*args, **kwargs)
+        # Remember the structure the item was loaded with, to detect changes when saving it.
+        if getattr(self, '_deferred', False):
+            self._original_structure = None  # Don't fetch deferred fields just for that
+        else:
+            self._original_structure = (self.parent_id, self.level, self.path)
+
     def save(self, force_insert=False, **kwargs):
-        from treemenus.utils import clean_ranks
+        from treemenus.utils import clean_ranks, update_descendants
 
-        # Calculate level
-        old_level = self.level
-        if self.parent:
-            self.level = self.parent.level + 1
+        creating = not self.pk
+        if creating:
+            old_parent_id = old_level = old_path = None
+        elif not self._state.adding and self._original_structure is not None:  # Loaded from (or already saved to) the database
+            old_parent_id, old_level, old_path = self._original_structure
         else:
-            self.level = 0
-
-        if self.pk:
-            new_parent = self.parent
-            old_parent = MenuItem.objects.get(pk=self.pk).parent
-            if old_parent != new_parent:
-                #If so, we need to recalculate the new ranks for the item and its siblings (both old and new ones).
-                if new_parent:
-                    clean_ranks(new_parent.children())  # Clean ranks for new siblings
-                    self.rank = new_parent.children().count()
-                super(MenuItem, self).save(force_insert, **kwargs)  # Save menu item in DB. It has now officially changed parent.
-                if old_parent:
-                    clean_ranks(old_parent.children())  # Clean ranks for old siblings
-            else:
-                super(MenuItem, self).save(force_insert, **kwargs)  # Save menu item in DB
+            old_parent_id, old_level, old_path = MenuItem.objects.values_list('parent', 'level', 'path').get(pk=self.pk)
+
+        old_menu_id = self.menu_id
+        if (creating or self.menu_id is None or self.parent_id != old_parent_id) and self.parent and self.parent.menu_id is not None:
+            self.menu_id = self.parent.menu_id  # Always inherit the menu so the item can be fetched along with the whole tree.
 
-        else:  # Saving the menu item for the first time (i.e creating the object)
-            if not self.has_siblings():
-                # No siblings - initial rank is 0.
-                self.rank = 0
+        if creating or self.parent_id != old_parent_id:
+            # Calculate level
+            if self.parent:
+                self.level = self.parent.level + 1
             else:
-                # Has siblings - initial rank is highest sibling rank plus 1.
-                siblings = self.siblings().order_by('-rank')
-                self.rank = siblings[0].rank + 1
-            super(MenuItem, self).save(force_insert, **kwargs)
+                self.level = 0
+            if creating:  # Saving the menu item for the first time (i.e creating the object)
+                if self.parent:
+                    sibling_ranks = MenuItem.objects.filter(parent=self.parent).order_by('-rank').values_list('rank', flat=True)[:1]
+                else:
+                    sibling_ranks = []
+                if not sibling_ranks:
+                    # No siblings - initial rank is 0.
+                    self.rank = 0
+                else:
+                    # Has siblings - initial rank is highest sibling rank plus 1.
+                    self.rank = sibling_ranks[0] + 1
+            elif self.parent:
+                # The item has changed parent, so we need to recalculate the new ranks for the item and its siblings (both old and new ones).
+                new_siblings = MenuItem.objects.filter(parent=self.parent).order_by('rank')
+                clean_ranks(new_siblings)  # Clean ranks for new siblings
+                self.rank = new_siblings.count()
+            self.path = self.get_path()
+            super(MenuItem, self).save(force_insert, **kwargs)  # Save menu item in DB. It has now officially changed parent.
+            if not creating and old_parent_id is not None:
+                clean_ranks(MenuItem.objects.filter(parent=old_parent_id).order_by('rank'))  # Clean ranks for old siblings
+        else:
+            # Same parent, so the level is unchanged and only the last segment of the path may change.
+            self.level = old_level
+            if old_path:
+                parent_path, separator, segment = old_path.rpartition(PATH_SEPARATOR)
+                self.path = get_child_path(separator and parent_path or None, self.rank)
+            else:
+                self.path = self.get_path()
+            super(MenuItem, self).save(force_insert, **kwargs)  # Save menu item in DB
 
-        # If level has changed, force children to refresh their own level
-        if old_level != self.level:
-            for child in self.children():
-                child.save()  # Just saving is enough, it'll refresh its level correctly.
+        # If level, path or menu have changed, refresh those of all descendants at once
+        if not creating and (old_level != self.level or old_path != self.path or old_menu_id != self.menu_id):
+            update_descendants(self, old_menu_id)
+            invalidate_menu(self.menu_id)
+            if old_menu_id != self.menu_id:
+                invalidate_menu(old_menu_id)
+        self._original_structure = (self.parent_id, self.level, self.path)
+
+    def get_path(self):
+        '''
+        Returns the item's materialized path, made of the zero-padded ranks of its ancestors
+        and of its own, e.g. '0000.0003.0001'. Sorting a menu's items by path puts them in
+        display order, and an item's descendants are the ones whose path starts with its own.
+        '''
+        return get_child_path(self.parent.path if self.parent else None, self.rank)
+
+    def clean(self):
+        if self.parent is not None and self.parent.level >= PATH_MAX_LEVEL:
+            raise ValidationError(ugettext('Menu items cannot be nested more than %d levels deep.') % PATH_MAX_LEVEL)
 
     def delete(self, using=None):
         from treemenus.utils import clean_ranks
         old_parent = self.parent
         super(MenuItem, self).delete()
         if old_parent:
-            clean_ranks(old_parent.children())
+            clean_ranks(MenuItem.objects.filter(parent=old_parent).order_by('rank'))
+
+    @property
+    def resolved_url(self):
+        '''
+        Returns the reversed named URL if the item has one (falling back to its URL if it
+        can't be reversed), or its URL otherwise.
+        '''
+        from treemenus.utils import resolve_named_url
+        if self.named_url:
+            try:
+                return resolve_named_url(self.named_url)
+            except NoReverseMatch:
+                pass
+        return self.url
+
+    @property
+    def is_active(self):
+        ''' Tells if the item matches the page being displayed (see set_active_item()). '''
+        active_item = getattr(_active_items, 'item', None)
+        return active_item is not None and active_item.pk == self.pk
+
+    @property
+    def is_ancestor_of_active(self):
+        ''' Tells if the item is an ancestor of the one matching the page being displayed. '''
+        return self.pk in getattr(_active_items, 'ancestor_pks', ())
 
     def caption_with_spacer(self):
-        spacer = ''
-        for i in range(0, self.level):
-            spacer += '&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;'
         if self.level > 0:
-            spacer += '|-&nbsp;'
-        return '%s%s' % (spacer, self.caption)
+            return '%s|-&nbsp;%s' % ('&nbsp;' * 5 * self.level, self.caption)
+        return self.caption
 
     def get_flattened(self):
-        flat_structure = [self]
-        for child in self.children():
-            flat_structure = chain(flat_structure, child.get_flattened())
-        return flat_structure
+        if self._tree_children is not None:
+            flat_structure = [self]
+            for child in self.children():
+                flat_structure = chain(flat_structure, child.get_flattened())
+            return flat_structure
+        # Fetch the whole subtree in display order with a single query
+        from treemenus.utils import get_subtree, uses_recursive_queries
+        if uses_recursive_queries():
+            subtree = list(get_subtree(self))[1:]
+        else:
+            subtree = list(self.get_descendants())
+        build_tree([self] + subtree, self.pk)
+        return [self] + subtree
+
+    def get_descendants(self):
+        ''' Returns all the item's descendants, in display order. '''
+        return MenuItem.objects.filter(menu=self.menu_id, path__startswith=self.path + PATH_SEPARATOR).order_by('path')
+
+    def get_ancestors(self):
+        ''' Returns all the item's ancestors, from the root item down to its parent. '''
+        segments = self.path.split(PATH_SEPARATOR)
+        paths = [PATH_SEPARATOR.join(segments[:length]) for length in range(1, len(segments))]
+        return MenuItem.objects.filter(menu=self.menu_id, path__in=paths).order_by('path')
+
+    def is_descendant_of(self, menu_item):
+        return self.menu_id == menu_item.menu_id and self.path.startswith(menu_item.path + PATH_SEPARATOR)
 
     def siblings(self):
         if not self.parent:
             return MenuItem.objects.none()
         else:
+            if self.parent._tree_children is not None:  # Parent was loaded as part of a whole tree
+                return [sibling for sibling in self.parent._tree_children if sibling.pk != self.pk]
             if not self.pk:  # If menu item not yet been saved in DB (i.e does not have a pk yet)
                 return self.parent.children()
             else:
                 return self.parent.children().exclude(pk=self.pk)
 
     def has_siblings(self):
-        return self.siblings().count() > 0
+        siblings = self.siblings()
+        if isinstance(siblings, list):
+            return len(siblings) > 0
+        return siblings.count() > 0
 
     def children(self):
+        if self._tree_children is not None:  # Loaded as part of a whole tree, see Menu.get_tree()
+            return self._tree_children
         _children = MenuItem.objects.filter(parent=self).order_by('rank',)
         for child in _children:
             child.parent = self  # Hack to avoid unnecessary DB queries further down the track.
         return _children
 
     def has_children(self):
+        if self._tree_children is not None:
+            return len(self._tree_children) > 0
         return self.children().count() > 0
 
 
 class Menu(models.Model):
-    name = models.CharField(_('name'), max_length=50)
+    name = models.CharField(_('name'), max_length=50, unique=True)
     root_item = models.ForeignKey(MenuItem, related_name='is_root_item_of', verbose_name=_('root item'), null=True, blank=True, editable=False)
 
     def save(self, force_insert=False, **kwargs):
@@ -117,6 +236,25 @@ class Menu(models.Model):
             self.root_item = root_item
         super(Menu, self).save(force_insert, **kwargs)
 
+    def get_tree(self, item_filter=None):
+        '''
+        Fetches every item of the menu, along with its extension objects, in a single query and
+        links them together in memory (see also load_trees()). Returns the root item, whose children() and has_children()
+        (and those of all its descendants, and their extensions) are then served without hitting
+        the database again.
+        If given an 'item_filter' (a Q object or a dict of lookups), only the items matching it are
+        fetched, and the descendants of the items left out are dropped along with them.
+        '''
+        return load_trees([self], item_filter).get(self.pk)
+
+    def clone(self, name, extensions=True):
+        '''
+        Returns a copy of the menu named 'name', with copies of all its items (and of their
+        extension objects, unless 'extensions' is False), created with a few bulk inserts.
+        '''
+        from treemenus.utils import clone_menu
+        return clone_menu(self, name, extensions)
+
     def delete(self, using=None):
         if self.root_item is not None:
             self.root_item.delete()
@@ -131,3 +269,149 @@ class Menu(models.Model):
     class Meta:
         verbose_name = _('menu')
         verbose_name_plural = _('menus')
+
+
+def get_child_path(parent_path, rank):
+    """
+    Returns the materialized path of the item ranked 'rank' under the item whose path is
+    'parent_path', or of a root item if it is None. Raises ValidationError if the rank is too
+    high for paths to sort in display order, or if the path is too long to be stored.
+    """
+    if rank > PATH_MAX_RANK:
+        raise ValidationError(ugettext('A menu item cannot have more than %d children.') % (PATH_MAX_RANK + 1))
+    if parent_path is None:
+        return PATH_SEGMENT_FORMAT % rank
+    path = '%s%s%s' % (parent_path, PATH_SEPARATOR, PATH_SEGMENT_FORMAT % rank)
+    if len(path) > PATH_MAX_LENGTH:
+        raise ValidationError(ugettext('Menu items cannot be nested more than %d levels deep.') % PATH_MAX_LEVEL)
+    return path
+
+
+def load_trees(menus, item_filter=None):
+    """
+    Loads the trees of all the given menus at once (see Menu.get_tree()), with a single query.
+    Returns the loaded root items, by menu pk.
+    """
+    from treemenus.utils import filter_subtree, resolve_named_urls, uses_recursive_queries
+    menus = [menu for menu in menus if menu.root_item_id is not None]
+    if not menus:
+        return {}
+    root_pks = [menu.root_item_id for menu in menus]
+    if uses_recursive_queries():
+        # Follow the parent links from the root items, whether the items have their menu set or not.
+        items = filter_subtree(MenuItem.objects.all(), root_pks).order_by('rank', 'pk')
+    else:
+        items = MenuItem.objects.filter(menu__in=[menu.pk for menu in menus]).order_by('path', 'rank')
+    items = list(_select_menu_items(items, root_pks, item_filter))
+    build_tree(items, None)
+    resolve_named_urls(items)
+    roots = dict((item.pk, item) for item in items if item.parent_id is None)
+    loaded_roots = {}
+    for menu in menus:
+        if menu.root_item_id in roots:
+            menu.root_item = loaded_roots[menu.pk] = roots[menu.root_item_id]
+    return loaded_roots
+
+
+def load_tree_window(menu, start_level=1, max_depth=None, active_path=None, expand=False, item_filter=None):
+    """
+    Loads part of the given menu's tree with a single query, without fetching the other items:
+    the items of the 'max_depth' levels (or of all levels, if None) starting at 'start_level',
+    level 1 being the children of the root item. Past level 1, only the items under the ancestor
+    of the item whose path is 'active_path' are loaded, along with the ancestors linking them to
+    the root item. If 'expand' is True, the children of the active item and of its ancestors are
+    loaded too, however deep they are. The items are linked together as by Menu.get_tree() and
+    the loaded root item is returned, or None if the window is empty.
+    """
+    from treemenus.utils import resolve_named_urls
+    segments = active_path and active_path.split(PATH_SEPARATOR) or []
+    if menu.root_item_id is None or (start_level > 1 and len(segments) < start_level):
+        return None
+    conditions = Q(pk=menu.root_item_id)
+    if start_level > 1:
+        ancestor_paths = [PATH_SEPARATOR.join(segments[:length]) for length in range(2, start_level + 1)]
+        conditions |= Q(path__in=ancestor_paths)
+        window = Q(path__startswith=ancestor_paths[-1] + PATH_SEPARATOR)
+    else:
+        window = Q(level__gte=1)
+    if max_depth is not None:
+        window &= Q(level__lt=start_level + max_depth)
+        if expand:
+            # The children of the items of the active branch lying past the window
+            for level in range(start_level + max_depth, len(segments) + 1):
+                window |= Q(level=level, path__startswith=PATH_SEPARATOR.join(segments[:level]) + PATH_SEPARATOR)
+    items = MenuItem.objects.filter(conditions | window, menu=menu.pk).order_by('path', 'rank')
+    items = list(_select_menu_items(items, [menu.root_item_id], item_filter))
+    menu.root_item = build_tree(items, menu.root_item_id)
+    resolve_named_urls(items)
+    return menu.root_item
+
+
+def _select_menu_items(items, root_pks, item_filter):
+    """
+    Fetches the extensions of the given menu items along with them, and only keeps the root
+    items and the ones matching 'item_filter' (a Q object or a dict of lookups), if given.
+    """
+    from treemenus.utils import get_menu_item_extension_relations
+    extension_names = [related.get_accessor_name() for related in get_menu_item_extension_relations()]
+    if extension_names:
+        items = items.select_related(*extension_names)
+    if item_filter is not None:
+        if isinstance(item_filter, dict):
+            item_filter = Q(**item_filter)
+        items = items.filter(Q(pk__in=root_pks) | item_filter).distinct()
+    return items
+
+
+def build_tree(items, root_pk):
+    """
+    Links the given menu items together (in the order they are given) and returns the one
+    whose pk is 'root_pk', or None if it isn't part of them. Items that can't be reached
+    from the root are simply left out.
+    """
+    items = list(items)
+    nodes = dict((item.pk, item) for item in items)
+    for item in items:
+        item._tree_children = []
+    for item in items:
+        parent = nodes.get(item.parent_id)
+        if parent is not None:
+            item.parent = parent  # Hack to avoid unnecessary DB queries further down the track.
+            parent._tree_children.append(item)
+    return nodes.get(root_pk)
+
+
+def set_active_item(menu_item, ancestor_pks=None):
+    """
+    Marks the given item of a loaded tree (or no item, if None) as the one matching the page
+    being displayed by the current thread, which the is_active and is_ancestor_of_active
+    properties of menu items then tell. Its ancestors are found from its parent links, unless
+    their pks are given, e.g. when the active item itself isn't loaded. Returns the previous
+    (menu_item, ancestor_pks) state, so that it can be restored once the menu is rendered.
+    """
+    previous_state = (getattr(_active_items, 'item', None), getattr(_active_items, 'ancestor_pks', set()))
+    if ancestor_pks is None:
+        ancestor_pks = set()
+        ancestor = menu_item is not None and menu_item.parent or None
+        while ancestor is not None:
+            ancestor_pks.add(ancestor.pk)
+            ancestor = ancestor.parent
+    _active_items.item = menu_item
+    _active_items.ancestor_pks = ancestor_pks
+    return previous_state
+
+
+def connect_extension_signals(sender, **kwargs):
+    ''' Connects the models extending MenuItem (see utils.get_menu_item_extension_relations()) to the cache invalidation. '''
+    for field in sender._meta.local_fields:
+        if isinstance(field, models.OneToOneField) and field.name == 'menu_item' and field.rel.to is MenuItem:
+            post_save.connect(menu_item_extension_changed, sender=sender)
+            post_delete.connect(menu_item_extension_changed, sender=sender)
+
+
+from treemenus.cache import invalidate_menu, menu_item_changed, menu_item_extension_changed, menu_changed
+post_save.connect(menu_item_changed, sender=MenuItem)
+post_delete.connect(menu_item_changed, sender=MenuItem)
+post_save.connect(menu_changed, sender=Menu)
+post_delete.connect(menu_changed, sender=Menu)
+class_prepared.connect(connect_extension_signals)  # Extension models can only be defined after MenuItem
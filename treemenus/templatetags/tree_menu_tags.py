@@ -3,20 +3,31 @@ import sys
 import django
 from django import template
 from django.conf import settings
+from django.core.urlresolvers import NoReverseMatch
 from django.template.defaulttags import url
-from django.template import Node, TemplateSyntaxError
+from django.template import Node, TemplateSyntaxError, TemplateDoesNotExist, Token, TOKEN_BLOCK
+from django.template.loader import get_template
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
 
 
 PY3 = sys.version_info[0] == 3
 if PY3:
     from django.utils import six
 
-from treemenus.models import Menu, MenuItem
+from treemenus.models import Menu, MenuItem, set_active_item
 from treemenus.config import APP_LABEL
+from treemenus.utils import get_active_item, get_active_path, get_breadcrumbs, get_loaded_branch, resolve_named_url
+from treemenus.cache import (get_menu_by_name, get_menu_tree, get_menu_window, get_named_menu_trees, get_cache_timeout,
+                             get_fragment_cache_key, get_shared_cache)
 
 
 register = template.Library()
 
+# Context variable holding the menus loaded by the load_menus tag, by (name, filter)
+LOADED_MENUS_KEY = 'treemenus_loaded_menus'
+
 
 @register.simple_tag
 def get_treemenus_static_prefix():
@@ -28,20 +39,365 @@ def get_treemenus_static_prefix():
         return admin_media_prefix() + 'img/admin/'
 
 
-def show_menu(context, menu_name, menu_type=None):
+def get_menu_or_none(menu_name):
     try:
-        menu = Menu.objects.get(name=menu_name)
+        return get_menu_by_name(menu_name)
     except Menu.DoesNotExist as e:
         if settings.TEMPLATE_DEBUG:
             raise e
         else:
-            return context
-    context['menu'] = menu
+            return None
+
+
+def get_loaded_menu(context, menu_name, item_filter=None):
+    ''' Returns the given menu if it was loaded by the load_menus tag, or None. '''
+    return (context.get(LOADED_MENUS_KEY) or {}).get((menu_name, item_filter))
+
+
+def get_menu_tree_or_none(context, menu_name, item_filter=None):
+    ''' Returns the given menu with its tree loaded, reusing the one loaded by load_menus if any. '''
+    menu = get_loaded_menu(context, menu_name, item_filter)
+    if menu is None:
+        menu = get_menu_or_none(menu_name)
+        if menu is not None:
+            menu = get_menu_tree(menu, item_filter)
+    return menu
+
+
+def get_current_url(context, kwargs):
+    ''' Returns the tag's 'url' argument if given, or else the path of the request being rendered, if any. '''
+    url = kwargs.get('url')
+    if url is None:
+        url = getattr(context.get('request'), 'path', None)
+    return url
+
+
+def get_window(kwargs):
+    '''
+    Returns the (start_level, max_depth, expand) window given to a tag by its 'start_level',
+    'max_depth' and 'expand' arguments, or None if the whole menu is to be displayed.
+    '''
+    try:
+        start_level = int(kwargs.get('start_level') or 1)
+        max_depth = kwargs.get('max_depth')
+        if max_depth not in (None, ''):
+            max_depth = int(max_depth)
+        else:
+            max_depth = None
+    except (ValueError, TypeError):
+        raise TemplateSyntaxError("The 'start_level' and 'max_depth' arguments must be integers")
+    expand = kwargs.get('expand') or None
+    if expand not in (None, 'active'):
+        raise TemplateSyntaxError("The 'expand' argument only accepts \"active\", not \"%s\"" % expand)
+    if start_level < 1 or (max_depth is not None and max_depth < 1):
+        raise TemplateSyntaxError("The 'start_level' and 'max_depth' arguments must be positive")
+    if start_level == 1 and max_depth is None:
+        return None
+    return start_level, max_depth, expand is not None
+
+
+def load_menu_window(menu, window, active_path, item_filter=None):
+    '''
+    Loads the given window of the menu (see get_window()) and returns a (menu, active_item,
+    ancestor_pks) tuple, the menu's root item being the item whose children are to be displayed,
+    followed by the arguments to pass to set_active_item(). The menu is None if nothing is to be
+    displayed.
+    '''
+    start_level, max_depth, expand = window
+    window_menu = get_menu_window(menu, start_level, max_depth, active_path, expand, item_filter)
+    if window_menu is None:
+        return None, None, None
+    branch = get_loaded_branch(window_menu.root_item, active_path)
+    if len(branch) < start_level:  # The ancestor to start from was filtered out
+        return None, None, None
+    start_item = branch[start_level - 1]
+    active_item = None
+    if active_path is None:
+        branch = []
+    elif branch[-1].path == active_path:
+        active_item = branch.pop()
+    displayed_menu = Menu(pk=window_menu.pk, name=window_menu.name, root_item_id=start_item.pk)
+    displayed_menu.root_item = start_item
+    return displayed_menu, active_item, set(menu_item.pk for menu_item in branch)
+
+
+def fill_menu_context(context, menu, menu_name, menu_type=None, item_filter=None, loaded=False):
+    if loaded:
+        context['menu'] = menu
+    else:
+        context['menu'] = get_menu_tree(menu, item_filter)  # Load the whole tree at once, so that rendering it doesn't hit the DB again.
     context['menu_name'] = menu_name
     if menu_type:
         context['menu_type'] = menu_type
     return context
-register.inclusion_tag('%s/menu.html' % APP_LABEL, takes_context=True)(show_menu)
+
+
+def show_menu(context, menu_name, menu_type=None, item_filter=None):
+    menu = get_menu_or_none(menu_name)
+    if menu is None:
+        return context
+    return fill_menu_context(context, menu, menu_name, menu_type, item_filter)
+
+
+def parse_tag_arguments(parser, token, allowed_kwargs, max_args):
+    """
+    Splits the given tag's contents into a list of positional arguments and a
+    dictionary of keyword arguments (given as name=value), both compiled as filters.
+    """
+    bits = token.split_contents()
+    tag_name = bits.pop(0)
+    args = []
+    kwargs = {}
+    for bit in bits:
+        name, equals, value = bit.partition('=')
+        if equals and name in allowed_kwargs:
+            kwargs[str(name)] = parser.compile_filter(value)
+        elif kwargs:
+            raise TemplateSyntaxError("'%s' received a positional argument after keyword arguments" % tag_name)
+        else:
+            args.append(parser.compile_filter(bit))
+    if not 1 <= len(args) <= max_args:
+        raise TemplateSyntaxError("'%s' takes between 1 and %s positional arguments" % (tag_name, max_args))
+    return args, kwargs
+
+
+class ShowMenuNode(Node):
+    def __init__(self, args, kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.template = None
+
+    def render(self, context):
+        args = [arg.resolve(context) for arg in self.args]
+        kwargs = dict((name, value.resolve(context)) for name, value in self.kwargs.items())
+        menu_name = args[0]
+        menu_type = args[1] if len(args) > 1 else None
+
+        item_filter = kwargs.get('filter') or None
+        window = get_window(kwargs)
+        loaded_menu = window is None and get_loaded_menu(context, menu_name, item_filter) or None
+        menu = loaded_menu or get_menu_or_none(menu_name)
+        url = get_current_url(context, kwargs)
+        active_path = active_item = None
+        if menu is not None and url:
+            # Find the active item up front, since the rendered HTML depends on it.
+            if window is not None:
+                active_path = get_active_path(menu, url)
+            else:
+                menu = loaded_menu = loaded_menu or get_menu_tree(menu, item_filter)
+                active_item = get_active_item(menu, url)
+        cache_key = None
+        if menu is not None and getattr(settings, 'TREEMENUS_FRAGMENT_CACHE', False):
+            vary_on = [menu_type, get_language(), kwargs.get('vary'), kwargs.get('filter')]
+            if window is not None:
+                vary_on.extend(window + (active_path,))
+            elif url:
+                vary_on.append(active_item and active_item.pk)
+            cache_key = get_fragment_cache_key(menu.pk, *vary_on)
+            html = get_shared_cache().get(cache_key)
+            if html is not None:
+                return html
+
+        if self.template is None:
+            self.template = get_template('%s/menu.html' % APP_LABEL)
+        context.push()
+        previous_state = None
+        try:
+            ancestor_pks = None
+            if menu is not None and window is not None:
+                menu, active_item, ancestor_pks = load_menu_window(menu, window, active_path, item_filter)
+                if menu is not None:
+                    fill_menu_context(context, menu, menu_name, menu_type, loaded=True)
+            elif menu is not None:
+                fill_menu_context(context, menu, menu_name, menu_type, item_filter, loaded=loaded_menu is not None)
+            previous_state = set_active_item(active_item, ancestor_pks)
+            html = self.template.render(context)
+        finally:
+            if previous_state is not None:
+                set_active_item(*previous_state)
+            context.pop()
+
+        if cache_key is not None:
+            get_shared_cache().set(cache_key, html, get_cache_timeout())
+        return html
+
+
+def do_show_menu(parser, token):
+    args, kwargs = parse_tag_arguments(parser, token, ('vary', 'filter', 'url', 'start_level', 'max_depth', 'expand'), 2)
+    return ShowMenuNode(args, kwargs)
+register.tag('show_menu', do_show_menu)
+
+
+class RenderMenuNode(Node):
+    """
+    Renders a whole menu as nested <ul> (or <ol>) lists, walking its tree iteratively
+    instead of recursively including 'treemenus/menu_item.html' for each item.
+    The contents of each <li> can be customized with the 'treemenus/menu_item_link.html'
+    template (or the one passed as the 'template' argument), which is compiled only once.
+    The 'treemenus/menu.html' and 'treemenus/menu_item.html' templates are not used.
+    """
+    def __init__(self, args, kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.item_templates = {}  # Compiled item templates, by name (None if it doesn't exist)
+
+    def render(self, context):
+        args = [arg.resolve(context) for arg in self.args]
+        kwargs = dict((name, value.resolve(context)) for name, value in self.kwargs.items())
+        menu_name = args[0]
+        menu_type = args[1] if len(args) > 1 else None
+
+        item_filter = kwargs.get('filter') or None
+        window = get_window(kwargs)
+        url = get_current_url(context, kwargs)
+        if window is None:
+            menu = get_menu_tree_or_none(context, menu_name, item_filter)
+            if menu is None:
+                return ''
+            active_item, ancestor_pks = url and get_active_item(menu, url) or None, None
+        else:
+            menu = get_menu_or_none(menu_name)
+            if menu is None:
+                return ''
+            menu, active_item, ancestor_pks = load_menu_window(menu, window, url and get_active_path(menu, url) or None, item_filter)
+            if menu is None:
+                return ''
+
+        template_name = kwargs.get('template') or '%s/menu_item_link.html' % APP_LABEL
+        if template_name not in self.item_templates:
+            try:
+                self.item_templates[template_name] = get_template(template_name)
+            except TemplateDoesNotExist:
+                if kwargs.get('template'):
+                    raise
+                self.item_templates[template_name] = None
+        item_template = self.item_templates[template_name]
+        if item_template is None:
+            render_item = render_menu_item_link
+        else:
+            def render_item(menu_item):
+                context.update({'menu_item': menu_item})
+                try:
+                    return item_template.render(context)
+                finally:
+                    context.pop()
+
+        context.update({'menu': menu, 'menu_name': menu_name, 'menu_type': menu_type})
+        previous_state = set_active_item(active_item, ancestor_pks)
+        try:
+            return render_tree(menu.root_item, menu_type == 'ordered-list' and 'ol' or 'ul', render_item)
+        finally:
+            set_active_item(*previous_state)
+            context.pop()
+
+
+def render_menu_item_link(menu_item):
+    return '<a href="%s">%s</a>' % (conditional_escape(menu_item.resolved_url), conditional_escape(menu_item.caption))
+
+
+def render_tree(root_item, list_tag, render_item):
+    """
+    Returns the HTML for the nested lists of the given item's descendants, each item's
+    <li> containing whatever render_item(menu_item) returns. The <li> of the active item
+    and of its ancestors (see set_active_item()) get the "active" and "ancestor" classes.
+    """
+    output = ['<%s>' % list_tag]
+    pending = [iter(root_item.children())]
+    while pending:
+        for menu_item in pending[-1]:
+            if menu_item.is_active:
+                output.append('<li class="active">')
+            elif menu_item.is_ancestor_of_active:
+                output.append('<li class="ancestor">')
+            else:
+                output.append('<li>')
+            output.append(render_item(menu_item))
+            children = menu_item.children()
+            if children:
+                output.append('<%s>' % list_tag)
+                pending.append(iter(children))
+                break
+            output.append('</li>')
+        else:
+            pending.pop()
+            output.append('</%s>' % list_tag)
+            if pending:
+                output.append('</li>')
+    return mark_safe(''.join(output))
+
+
+def do_render_menu(parser, token):
+    args, kwargs = parse_tag_arguments(parser, token, ('template', 'filter', 'url', 'start_level', 'max_depth', 'expand'), 2)
+    return RenderMenuNode(args, kwargs)
+register.tag('render_menu', do_render_menu)
+
+
+class MenuBreadcrumbsNode(Node):
+    """
+    Renders the links to the items of a menu leading to the one matching the current page
+    (or the given URL), as an <ol> list, or puts those items in the context if given a
+    variable name.
+    """
+    def __init__(self, args, kwargs, var_name=None):
+        self.args = args
+        self.kwargs = kwargs
+        self.var_name = var_name
+
+    def render(self, context):
+        menu_name = self.args[0].resolve(context)
+        kwargs = dict((name, value.resolve(context)) for name, value in self.kwargs.items())
+        menu = get_menu_tree_or_none(context, menu_name, kwargs.get('filter') or None)
+        url = get_current_url(context, kwargs)
+        breadcrumbs = menu is not None and url and get_breadcrumbs(menu, url) or []
+        if self.var_name is not None:
+            context[self.var_name] = breadcrumbs
+            return ''
+        if not breadcrumbs:
+            return ''
+        return mark_safe('<ol>%s</ol>' % ''.join('<li>%s</li>' % render_menu_item_link(menu_item) for menu_item in breadcrumbs))
+
+
+def do_menu_breadcrumbs(parser, token):
+    bits = token.split_contents()
+    var_name = None
+    if len(bits) > 2 and bits[-2] == 'as':
+        var_name = bits[-1]
+        token = Token(TOKEN_BLOCK, ' '.join(bits[:-2]))
+    args, kwargs = parse_tag_arguments(parser, token, ('filter', 'url'), 1)
+    return MenuBreadcrumbsNode(args, kwargs, var_name)
+register.tag('menu_breadcrumbs', do_menu_breadcrumbs)
+
+
+class LoadMenusNode(Node):
+    """
+    Loads several menus and their trees at once, and puts them in the context as a dictionary
+    of menus by name. The show_menu and render_menu tags that come after it then reuse them.
+    """
+    def __init__(self, args, kwargs, var_name):
+        self.args = args
+        self.kwargs = kwargs
+        self.var_name = var_name
+
+    def render(self, context):
+        menu_names = [arg.resolve(context) for arg in self.args]
+        kwargs = dict((name, value.resolve(context)) for name, value in self.kwargs.items())
+        item_filter = kwargs.get('filter') or None
+        menus = get_named_menu_trees(menu_names, item_filter)
+        loaded_menus = dict(context.get(LOADED_MENUS_KEY) or {})
+        for menu_name, menu in menus.items():
+            loaded_menus[(menu_name, item_filter)] = menu
+        context[LOADED_MENUS_KEY] = loaded_menus
+        context[self.var_name] = menus
+        return ''
+
+
+def do_load_menus(parser, token):
+    bits = token.split_contents()
+    if len(bits) < 4 or bits[-2] != 'as':
+        raise TemplateSyntaxError("'%s' takes menu names followed by 'as' and a variable name" % bits[0])
+    args, kwargs = parse_tag_arguments(parser, Token(TOKEN_BLOCK, ' '.join(bits[:-2])), ('filter',), len(bits))
+    return LoadMenusNode(args, kwargs, bits[-1])
+register.tag('load_menus', do_load_menus)
 
 
 def show_menu_item(context, menu_item):
@@ -63,6 +419,11 @@ class ReverseNamedURLNode(Node):
         from django.template import TOKEN_BLOCK, Token
 
         resolved_named_url = self.named_url.resolve(context)
+        try:
+            return resolve_named_url(resolved_named_url, current_app=getattr(context, 'current_app', None))
+        except NoReverseMatch:
+            pass  # Let the url tag deal with it, e.g. raise a detailed error.
+
         if django.VERSION >= (1, 3):
             contents = 'url "%s"' % resolved_named_url
         else:
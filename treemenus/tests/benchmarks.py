@@ -0,0 +1,44 @@
+"""
+Compares the time taken to render a deep menu with the recursive show_menu tag and with
+the render_menu tag, with and without a per-item template. Run with:
+
+    DJANGO_SETTINGS_MODULE=treemenus.tests.settings django-admin.py test treemenus.tests.benchmarks
+"""
+import timeit
+
+from django import template
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from treemenus.models import Menu, MenuItem
+
+
+@override_settings(TREEMENUS_CACHE='local')  # Only measure the rendering, not the loading of the tree
+class RenderMenuBenchmark(TestCase):
+    depth = 6
+    branching = 3
+    repeat = 5
+
+    def setUp(self):
+        menu = Menu.objects.create(name='benchmark')
+        parents = [menu.root_item]
+        for level in range(self.depth):
+            children = []
+            for parent in parents:
+                for i in range(self.branching):
+                    children.append(MenuItem.objects.create(caption='item %s.%s' % (parent.pk, i), url='/%s/' % i, parent=parent))
+            parents = children
+
+    def time_template(self, source):
+        t = template.Template('{% load tree_menu_tags %}' + source)
+        t.render(template.Context())  # Warm up the template loaders
+        return min(timeit.repeat(lambda: t.render(template.Context()), number=1, repeat=self.repeat))
+
+    def test_render_menu_is_faster(self):
+        recursive = self.time_template('{% show_menu "benchmark" "unordered-list" %}')
+        iterative = self.time_template('{% render_menu "benchmark" "unordered-list" %}')
+        with_template = self.time_template('{% render_menu "benchmark" "unordered-list" template="treemenus/custom_menu_item_link.html" %}')
+        print('\n%s items: show_menu %.4fs, render_menu %.4fs (%.1fx faster), render_menu with an item template %.4fs (%.1fx faster)' % (
+            MenuItem.objects.count() - 1, recursive, iterative, recursive / iterative, with_template, recursive / with_template))
+        # The ratios are reported above; only check the ordering, since timings vary too much between machines.
+        self.assertTrue(iterative < with_template < recursive)
@@ -0,0 +1,7 @@
+from django.conf.urls import url
+from django.conf.urls.i18n import i18n_patterns
+from django.views.defaults import page_not_found
+
+urlpatterns = i18n_patterns('',
+        url(r'^news/$', page_not_found, name='news'),
+    )
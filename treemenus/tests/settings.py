@@ -1,3 +1,5 @@
+import os
+
 # For Django 1.1 and under
 DATABASE_ENGINE = 'django.db.backends.sqlite3'
 
@@ -22,3 +24,7 @@ SECRET_KEY = 'Shush... Tell no one.'
 
 # For Django 1.3 and above
 STATIC_URL = '/static/'
+
+TEMPLATE_DIRS = [
+    os.path.join(os.path.dirname(__file__), 'templates'),
+]
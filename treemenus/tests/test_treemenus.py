@@ -2,24 +2,43 @@ try:
     from imp import reload  # Python 3
 except ImportError:
     pass
+import json
+import os
+import shutil
+import tempfile
+
 from django.test import TestCase
+from django.test.client import RequestFactory
 from django.conf import settings
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.db.models.loading import load_app
 from django import template
 from django.template.loaders import app_directories
 from django.contrib.auth.models import User
 import django
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, NoReverseMatch, clear_url_caches, get_resolver, set_script_prefix, get_script_prefix
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.forms import ValidationError
+from django.utils import translation
+from django.utils.six import StringIO
 
 try:
     from django.utils.encoding import smart_bytes
 except ImportError:  # Django < 1.5
     smart_bytes = str
 
-from treemenus.models import Menu, MenuItem
-from treemenus.utils import move_item, clean_ranks, move_item_or_clean_ranks
+from treemenus.models import Menu, MenuItem, PATH_MAX_LEVEL, PATH_MAX_RANK, get_child_path, set_active_item
+from treemenus.utils import (move_item, clean_ranks, move_item_or_clean_ranks, get_parent_choices, get_parent_choice_items,
+                             MenuItemChoiceField, register_menu_item_filter, get_subtree, update_descendants,
+                             uses_recursive_queries, get_active_item, get_active_path, get_breadcrumbs, get_url_paths,
+                             _reversed_named_urls)
 from treemenus.templatetags.tree_menu_tags import show_menu
+from treemenus.cache import (get_menu_by_name, get_menu_tree, get_menu_version, get_menu_window, get_named_menu_trees,
+                             get_shared_cache, local_cache)
 
 
 class TreemenusTestCase(TestCase):
@@ -30,6 +49,9 @@ class TreemenusTestCase(TestCase):
         self.old_INSTALLED_APPS = settings.INSTALLED_APPS
         settings.INSTALLED_APPS += ['treemenus.tests.fake_menu_extension']
         load_app('treemenus.tests.fake_menu_extension')
+        # Forget the reverse relations cached before the extension was loaded
+        for cache_name in ('_related_objects_cache', '_related_objects_proxy_cache', '_name_map'):
+            MenuItem._meta.__dict__.pop(cache_name, None)
         call_command('syncdb', verbosity=0, interactive=False)
 
         # since django's r11862 templatags_modules and app_template_dirs are cached
@@ -631,18 +653,15 @@ class TreemenusTestCase(TestCase):
         menu_item4.rank = 99
         menu_item4.save()
 
-        move_item_or_clean_ranks(menu_item1, 1)  # Try to move down
+        move_item_or_clean_ranks(menu_item1, 1)  # Move down, past the gap in the ranks
 
-        # Retrieve objects from db
-        menu_item1 = MenuItem.objects.get(caption='menu_item1', parent=menu.root_item)
-        menu_item2 = MenuItem.objects.get(caption='menu_item2', parent=menu.root_item)
-        menu_item3 = MenuItem.objects.get(caption='menu_item3', parent=menu.root_item)
-        menu_item4 = MenuItem.objects.get(caption='menu_item4', parent=menu.root_item)
+        self.assertEqual(list(MenuItem.objects.filter(parent=menu.root_item).order_by('rank').values_list('caption', 'rank')),
+                         [('menu_item2', -1), ('menu_item3', 6), ('menu_item4', 18), ('menu_item1', 99)])
 
-        self.assertEqual(menu_item1.rank, 3)
-        self.assertEqual(menu_item2.rank, 0)
-        self.assertEqual(menu_item3.rank, 1)
-        self.assertEqual(menu_item4.rank, 2)
+        # Items ranked the same can't be told apart, so the ranks get cleaned
+        MenuItem.objects.filter(parent=menu.root_item).update(rank=5)
+        move_item_or_clean_ranks(MenuItem.objects.get(pk=menu_item1.pk), 1)
+        self.assertEqual(sorted(MenuItem.objects.filter(parent=menu.root_item).values_list('rank', flat=True)), [0, 1, 2, 3])
 
     def test_menu_create(self):
         # Regression test for issue #18
@@ -686,3 +705,1093 @@ class TreemenusTestCase(TestCase):
         self.assertRaises(Menu.DoesNotExist, show_menu, *args)
 
         settings.TEMPLATE_DEBUG = old_TEMPLATE_DEBUG
+
+    def test_get_tree(self):
+        menu = Menu.objects.create(name='menu_get_tree')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu.root_item)
+        menu_item3 = MenuItem.objects.create(caption='menu_item3', parent=menu_item1)
+        menu_item4 = MenuItem.objects.create(caption='menu_item4', parent=menu_item1)
+        menu_item5 = MenuItem.objects.create(caption='menu_item5', parent=menu_item4)
+        move_item(menu_item4, -1)
+
+        # Items created in code inherit their parent's menu
+        self.assertEqual(MenuItem.objects.get(pk=menu_item5.pk).menu, menu)
+
+        menu = Menu.objects.get(pk=menu.pk)
+        with self.assertNumQueries(1):
+            root_item = menu.get_tree()
+        self.assertEqual(root_item, menu.root_item)
+
+        def walk(menu_item):
+            return [(child.caption, child.level, child.has_children(), walk(child)) for child in menu_item.children()]
+
+        with self.assertNumQueries(0):
+            tree = walk(menu.root_item)
+            siblings = [sibling.caption for sibling in menu.root_item.children()[0].children()[0].siblings()]
+        self.assertEqual(tree, [
+            ('menu_item1', 1, True, [
+                ('menu_item4', 2, True, [
+                    ('menu_item5', 3, False, []),
+                ]),
+                ('menu_item3', 2, False, []),
+            ]),
+            ('menu_item2', 1, False, []),
+        ])
+        self.assertEqual(siblings, ['menu_item3'])
+
+        # The template tag loads the whole tree
+        context = show_menu({}, 'menu_get_tree')
+        with self.assertNumQueries(0):
+            self.assertEqual(walk(context['menu'].root_item), tree)
+
+    @override_settings(TREEMENUS_CACHE='local')
+    def test_local_cache(self):
+        local_cache.clear()
+        menu = Menu.objects.create(name='menu_local_cache')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+
+        with self.assertNumQueries(1):
+            cached_menu = get_menu_tree(menu)
+        self.assertEqual([item.caption for item in cached_menu.root_item.children()], ['menu_item1'])
+        with self.assertNumQueries(0):
+            self.assertTrue(get_menu_tree(Menu(pk=menu.pk)) is cached_menu)
+
+        # Saving an item invalidates the cached tree
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu.root_item)
+        self.assertEqual([item.caption for item in get_menu_tree(menu).root_item.children()], ['menu_item1', 'menu_item2'])
+
+        # ... and so does deleting one
+        menu_item1.delete()
+        self.assertEqual([item.caption for item in get_menu_tree(menu).root_item.children()], ['menu_item2'])
+
+        # ... or changing the menu itself
+        menu.name = 'menu_local_cache_renamed'
+        menu.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_menu_tree(menu).name, 'menu_local_cache_renamed')
+
+    @override_settings(TREEMENUS_CACHE='local', TREEMENUS_LOCAL_CACHE_SIZE=2)
+    def test_local_cache_eviction(self):
+        local_cache.clear()
+        menu1 = Menu.objects.create(name='menu_eviction1')
+        menu2 = Menu.objects.create(name='menu_eviction2')
+        menu3 = Menu.objects.create(name='menu_eviction3')
+        get_menu_tree(menu1)
+        get_menu_tree(menu2)
+        get_menu_tree(menu1)  # menu2 is now the least recently used
+        get_menu_tree(menu3)
+        self.assertEqual(len(local_cache), 2)
+        with self.assertNumQueries(0):
+            get_menu_tree(menu1)
+            get_menu_tree(menu3)
+        with self.assertNumQueries(1):
+            get_menu_tree(menu2)
+
+    @override_settings(TREEMENUS_CACHE='shared')
+    def test_shared_cache(self):
+        get_shared_cache().clear()
+        menu = Menu.objects.create(name='menu_shared_cache')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu_item1)
+
+        get_menu_tree(menu)
+        with self.assertNumQueries(0):
+            cached_menu = get_menu_tree(Menu(pk=menu.pk))
+            self.assertEqual(cached_menu.name, 'menu_shared_cache')
+            root_item = cached_menu.root_item
+            self.assertEqual(root_item.pk, menu.root_item.pk)
+            self.assertEqual([item.caption for item in root_item.children()], ['menu_item1'])
+            self.assertEqual([item.caption for item in root_item.children()[0].children()], ['menu_item2'])
+            self.assertEqual(root_item.children()[0].children()[0].parent.parent, root_item)
+
+        # Changes are seen by all processes
+        menu_item1.caption = 'menu_item1 changed'
+        menu_item1.save()
+        with self.assertNumQueries(1):
+            cached_menu = get_menu_tree(menu)
+        self.assertEqual([item.caption for item in cached_menu.root_item.children()], ['menu_item1 changed'])
+
+    @override_settings(TREEMENUS_CACHE='both')
+    def test_both_cache_tiers(self):
+        get_shared_cache().clear()
+        local_cache.clear()
+        menu = Menu.objects.create(name='menu_both_cache_tiers')
+        MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+
+        cached_menu = get_menu_tree(menu)
+        self.assertTrue(get_menu_tree(Menu(pk=menu.pk)) is cached_menu)
+
+        # Another process starting with an empty local cache gets the tree from the shared cache
+        local_cache.clear()
+        with self.assertNumQueries(0):
+            cached_menu = get_menu_tree(Menu(pk=menu.pk))
+        self.assertEqual([item.caption for item in cached_menu.root_item.children()], ['menu_item1'])
+
+        MenuItem.objects.create(caption='menu_item2', parent=menu.root_item)
+        cached_menu = get_menu_tree(menu)
+        self.assertEqual([item.caption for item in cached_menu.root_item.children()], ['menu_item1', 'menu_item2'])
+
+    @override_settings(TREEMENUS_FRAGMENT_CACHE=True)
+    def test_show_menu_fragment_cache(self):
+        get_shared_cache().clear()
+        menu = Menu.objects.create(name='menu_fragment_cache')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        MenuItem.objects.create(caption='menu_item2', parent=menu_item1)
+
+        t = template.Template('{% load tree_menu_tags %}{% show_menu "menu_fragment_cache" menu_type vary=vary %}')
+        context = template.Context({'menu_type': 'unordered-list', 'vary': 'a'})
+        html = t.render(context)
+        self.assertTrue('<li><a href="">menu_item2</a></li>' in html)
+        self.assertFalse('menu' in context)
+
+        with self.assertNumQueries(0):  # The menu name was resolved before
+            self.assertEqual(t.render(template.Context({'menu_type': 'unordered-list', 'vary': 'a'})), html)
+
+        # The menu type, vary key and language are part of the cache key
+        self.assertTrue('<ol>' in t.render(template.Context({'menu_type': 'ordered-list', 'vary': 'a'})))
+        with self.assertNumQueries(1):
+            t.render(template.Context({'menu_type': 'unordered-list', 'vary': 'b'}))
+        translation.activate('fr')
+        try:
+            with self.assertNumQueries(1):
+                t.render(template.Context({'menu_type': 'unordered-list', 'vary': 'a'}))
+        finally:
+            translation.deactivate()
+
+        # Changing an item invalidates the cached fragments
+        menu_item1.caption = 'menu_item1 changed'
+        menu_item1.save()
+        self.assertTrue('menu_item1 changed' in t.render(template.Context({'menu_type': 'unordered-list', 'vary': 'a'})))
+
+        # So is the active item
+        MenuItem.objects.create(caption='menu_item_a', url='/a/', parent=menu.root_item)
+        MenuItem.objects.create(caption='menu_item_b', url='/b/', parent=menu.root_item)
+        t = template.Template('{% load tree_menu_tags %}{% show_menu "menu_fragment_cache" "unordered-list" url=url %}')
+        self.assertTrue('<li class="active"><a href="/a/">menu_item_a</a></li>' in t.render(template.Context({'url': '/a/'})))
+        html = t.render(template.Context({'url': '/b/'}))
+        self.assertTrue('<li class="active"><a href="/b/">menu_item_b</a></li>' in html)
+        self.assertEqual(html.count('class="active"'), 1)
+        self.assertEqual(t.render(template.Context({'url': '/b/2013/'})), html)
+
+    @override_settings(TREEMENUS_CACHE='local', TREEMENUS_FRAGMENT_CACHE=True)
+    def test_local_cache_with_fragment_cache(self):
+        from treemenus import cache
+        get_shared_cache().clear()
+        local_cache.clear()
+        menu = Menu.objects.create(name='menu_local_fragment_cache')
+        menu_item = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        t = template.Template('{% load tree_menu_tags %}{% show_menu "menu_local_fragment_cache" "unordered-list" %}')
+        self.assertTrue('menu_item1' in t.render(template.Context()))
+        with self.assertNumQueries(0):
+            get_menu_tree(menu)
+
+        # Another process changes the item: this one's locally cached tree is stale, and must
+        # not get rendered and cached as the fragment of the new version
+        versions = dict(cache._versions)
+        menu_item.caption = 'menu_item1 changed'
+        menu_item.save()
+        cache._versions.clear()
+        cache._versions.update(versions)
+        self.assertTrue('menu_item1 changed' in t.render(template.Context()))
+        self.assertEqual([item.caption for item in get_menu_tree(menu).root_item.children()], ['menu_item1 changed'])
+
+    def test_render_menu(self):
+        menu = Menu.objects.create(name='menu_render_menu')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', url='/1/', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', url='/2/?a=1&b=2', parent=menu_item1)
+        menu_item3 = MenuItem.objects.create(caption='menu_item3', parent=menu_item2)
+        menu_item4 = MenuItem.objects.create(caption='<menu_item4>', parent=menu_item1)
+        menu_item5 = MenuItem.objects.create(caption='menu_item5', parent=menu.root_item)
+
+        t = template.Template('{% load tree_menu_tags %}{% render_menu "menu_render_menu" "unordered-list" %}')
+        self.assertEqual(t.render(template.Context()),
+            '<ul><li><a href="/1/">menu_item1</a>'
+            '<ul><li><a href="/2/?a=1&amp;b=2">menu_item2</a><ul><li><a href="">menu_item3</a></li></ul></li>'
+            '<li><a href="">&lt;menu_item4&gt;</a></li></ul></li>'
+            '<li><a href="">menu_item5</a></li></ul>')
+
+        t = template.Template('{% load tree_menu_tags %}{% render_menu "menu_render_menu" menu_type template="treemenus/custom_menu_item_link.html" %}')
+        context = template.Context({'menu_type': 'ordered-list'})
+        self.assertEqual(t.render(context),
+            '<ol><li><a class="level1" href="/1/">menu_item1</a> (ordered-list)'
+            '<ol><li><a class="level2" href="/2/?a=1&amp;b=2">menu_item2</a> (ordered-list)<ol><li><a class="level3" href="">menu_item3</a> (ordered-list)</li></ol></li>'
+            '<li><a class="level2" href="">&lt;menu_item4&gt;</a> (ordered-list)</li></ol></li>'
+            '<li><a class="level1" href="">menu_item5</a> (ordered-list)</li></ol>')
+        self.assertFalse('menu_item' in context)
+
+    def test_named_urls_reversed_with_tree(self):
+        menu = Menu.objects.create(name='menu_named_urls')
+        MenuItem.objects.create(caption='menu_item1', named_url='admin:index', parent=menu.root_item)
+        MenuItem.objects.create(caption='menu_item2', url='/2/', named_url='does-not-exist', parent=menu.root_item)
+        MenuItem.objects.create(caption='menu_item3', url='/3/', parent=menu.root_item)
+
+        clear_url_caches()
+        root_item = menu.get_tree()
+        self.assertEqual(_reversed_named_urls[get_resolver(None)], {('admin:index', '/', translation.get_language(), None): '/test_treemenus_admin/'})
+        self.assertEqual([item.resolved_url for item in root_item.children()], ['/test_treemenus_admin/', '/2/', '/3/'])
+
+        t = template.Template('{% load tree_menu_tags %}{% reverse_named_url menu_item.named_url %}')
+        self.assertEqual(t.render(template.Context({'menu_item': root_item.children()[0]})), '/test_treemenus_admin/')
+        self.assertRaises(NoReverseMatch, t.render, template.Context({'menu_item': root_item.children()[1]}))
+
+        # Named URLs are reversed again when the URLconf or the script prefix change
+        old_script_prefix = get_script_prefix()
+        set_script_prefix('/prefix/')
+        try:
+            self.assertEqual(root_item.children()[0].resolved_url, '/prefix/test_treemenus_admin/')
+        finally:
+            set_script_prefix(old_script_prefix)
+        _reversed_named_urls[get_resolver(None)][('admin:index', '/', translation.get_language(), None)] = '/stale/'
+        self.assertEqual(root_item.children()[0].resolved_url, '/stale/')
+        clear_url_caches()
+        self.assertEqual(root_item.children()[0].resolved_url, '/test_treemenus_admin/')
+
+    def test_named_urls_per_language(self):
+        if django.VERSION < (1, 4):  # No i18n_patterns()
+            return
+        menu = Menu.objects.create(name='menu_named_urls_i18n')
+        menu_item = MenuItem.objects.create(caption='news', named_url='news', parent=menu.root_item)
+        t = template.Template('{% load tree_menu_tags %}{% reverse_named_url "news" %}')
+        self.addCleanup(clear_url_caches)
+        with override_settings(ROOT_URLCONF='treemenus.tests.i18n_urls', TREEMENUS_CACHE='local'):
+            clear_url_caches()
+            local_cache.clear()
+            for language in ('en', 'fr'):
+                translation.activate(language)
+                try:
+                    self.assertEqual(t.render(template.Context()), '/%s/news/' % language)
+                    self.assertEqual(MenuItem.objects.get(pk=menu_item.pk).resolved_url, '/%s/news/' % language)
+                    self.assertEqual(get_active_item(get_menu_tree(menu), '/%s/news/' % language).pk, menu_item.pk)
+                    self.assertEqual(get_active_path(menu, '/%s/news/' % language), menu_item.path)
+                    self.assertEqual(sorted(get_url_paths(menu, '/%s/news/' % language)), ['/%s/news' % language])
+                finally:
+                    translation.deactivate()
+
+    def test_clean_ranks_single_update(self):
+        menu = Menu.objects.create(name='menu_clean_ranks_single_update')
+        menu_items = [MenuItem.objects.create(caption='menu_item%s' % i, parent=menu.root_item) for i in range(400)]
+        MenuItem.objects.filter(pk__in=[menu_item.pk for menu_item in menu_items[:200]]).update(rank=1000)
+
+        siblings = list(menu.root_item.children())
+        with CaptureQueriesContext(connection) as queries:
+            clean_ranks(siblings)
+        updates = [query for query in queries.captured_queries if 'UPDATE' in query['sql']]
+        self.assertEqual(len(updates), 5)  # 2 batches of 300 ranks, then 3 batches of 180 levels and paths
+        self.assertEqual(list(menu.root_item.children().values_list('rank', flat=True)), list(range(400)))
+        self.assertEqual([menu_item.rank for menu_item in siblings], list(range(400)))
+        self.assertEqual(MenuItem.objects.get(pk=menu_items[0].pk).rank, 200)
+
+    def test_level_changes_update_descendants_at_once(self):
+        menu = Menu.objects.create(name='menu_level_changes')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu.root_item)
+        menu_item3 = MenuItem.objects.create(caption='menu_item3', parent=menu.root_item)
+
+        def create_branch(parent, depth, width):
+            menu_items = []
+            for i in range(width):
+                menu_item = MenuItem.objects.create(caption='child', parent=parent)
+                menu_items.append(menu_item)
+                if depth > 1:
+                    menu_items.extend(create_branch(menu_item, depth - 1, width))
+            return menu_items
+
+        small_branch = create_branch(menu_item1, 2, 1)
+        large_branch = create_branch(menu_item2, 4, 3)
+
+        def move(menu_item, parent):
+            menu_item = MenuItem.objects.get(pk=menu_item.pk)
+            menu_item.parent = parent
+            with CaptureQueriesContext(connection) as queries:
+                menu_item.save()
+            return len(queries)
+
+        # Moving a large branch takes as many queries as moving a small one
+        small_branch_queries = move(menu_item1, menu_item3)
+        move(menu_item1, menu.root_item)
+        self.assertEqual(move(menu_item2, menu_item3), small_branch_queries)
+
+        self.assertEqual(MenuItem.objects.get(pk=menu_item1.pk).level, 1)
+        self.assertEqual(MenuItem.objects.get(pk=menu_item2.pk).level, 2)
+        for menu_item in small_branch + large_branch:
+            menu_item = MenuItem.objects.get(pk=menu_item.pk)
+            self.assertEqual(menu_item.level, menu_item.parent.level + 1)
+
+    def test_paths(self):
+        menu = Menu.objects.create(name='menu_paths')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu.root_item)
+        menu_item3 = MenuItem.objects.create(caption='menu_item3', parent=menu_item1)
+        menu_item4 = MenuItem.objects.create(caption='menu_item4', parent=menu_item3)
+        menu_item5 = MenuItem.objects.create(caption='menu_item5', parent=menu_item1)
+
+        def paths():
+            return dict(MenuItem.objects.filter(menu=menu).values_list('caption', 'path'))
+
+        self.assertEqual(paths(), {
+            'root': '0000',
+            'menu_item1': '0000.0000',
+            'menu_item3': '0000.0000.0000',
+            'menu_item4': '0000.0000.0000.0000',
+            'menu_item5': '0000.0000.0001',
+            'menu_item2': '0000.0001',
+        })
+
+        # Moving items around updates the paths of their whole subtree
+        move_item(menu_item2, -1)
+        menu_item3 = MenuItem.objects.get(pk=menu_item3.pk)
+        menu_item3.parent = MenuItem.objects.get(pk=menu_item2.pk)
+        menu_item3.save()
+        self.assertEqual(paths(), {
+            'root': '0000',
+            'menu_item2': '0000.0000',
+            'menu_item3': '0000.0000.0000',
+            'menu_item4': '0000.0000.0000.0000',
+            'menu_item1': '0000.0001',
+            'menu_item5': '0000.0001.0000',
+        })
+        MenuItem.objects.get(pk=menu_item2.pk).delete()
+        self.assertEqual(paths(), {
+            'root': '0000',
+            'menu_item1': '0000.0000',
+            'menu_item5': '0000.0000.0000',
+        })
+
+        # Subtree and ancestor lookups are single queries
+        menu_item5 = MenuItem.objects.get(pk=menu_item5.pk)
+        menu_item6 = MenuItem.objects.create(caption='menu_item6', parent=menu_item5)
+        menu_item1 = MenuItem.objects.get(pk=menu_item1.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual([item.caption for item in menu.root_item.get_flattened()], ['root', 'menu_item1', 'menu_item5', 'menu_item6'])
+        with self.assertNumQueries(1):
+            self.assertEqual([item.caption for item in menu_item1.get_descendants()], ['menu_item5', 'menu_item6'])
+        with self.assertNumQueries(1):
+            self.assertEqual([item.caption for item in menu_item6.get_ancestors()], ['root', 'menu_item1', 'menu_item5'])
+        self.assertTrue(menu_item6.is_descendant_of(menu_item1))
+        self.assertFalse(menu_item1.is_descendant_of(menu_item6))
+        self.assertFalse(menu_item1.is_descendant_of(menu_item1))
+
+    def test_rebuild_command(self):
+        menu = Menu.objects.create(name='menu_rebuild_command')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu_item1)
+        expected = list(MenuItem.objects.filter(menu=menu).order_by('pk').values_list('level', 'path'))
+
+        MenuItem.objects.filter(menu=menu).update(level=0, path='')
+        call_command('treemenus_rebuild', verbosity=0)
+        self.assertEqual(list(MenuItem.objects.filter(menu=menu).order_by('pk').values_list('level', 'path')), expected)
+
+    def test_save_without_structure_changes(self):
+        menu = Menu.objects.create(name='menu_save_without_structure_changes')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu.root_item)
+        menu_item3 = MenuItem.objects.create(caption='menu_item3', parent=menu_item1)
+
+        # Saving an item loaded from the database doesn't fetch it again
+        menu_item1 = MenuItem.objects.get(pk=menu_item1.pk)
+        menu_item1.caption = 'menu_item1 changed'
+        with self.assertNumQueries(1):
+            menu_item1.save()
+
+        # Nor does saving it again
+        menu_item1.url = '/1/'
+        with self.assertNumQueries(1):
+            menu_item1.save()
+
+        # Changing the rank only refreshes the descendants' paths
+        menu_item1.rank = 1
+        with self.assertNumQueries(3):  # Update the item, fetch the menu's structure, update the descendants
+            menu_item1.save()
+        self.assertEqual(MenuItem.objects.get(pk=menu_item3.pk).path, '0000.0001.0000')
+
+        # Items that weren't loaded from the database are compared to what is stored
+        menu_item3 = MenuItem(pk=menu_item3.pk, caption='menu_item3', parent=MenuItem.objects.get(pk=menu_item2.pk))
+        menu_item3.save()
+        menu_item3 = MenuItem.objects.get(pk=menu_item3.pk)
+        self.assertEqual(menu_item3.parent_id, menu_item2.pk)
+        self.assertEqual(menu_item3.rank, 0)
+        self.assertEqual(menu_item3.level, 2)
+        self.assertFalse(MenuItem.objects.filter(parent=menu_item1).exists())
+
+    def test_view_menu_items_listing(self):
+        menu = Menu.objects.create(name='menu_items_listing')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu_item1)
+        menu_item3 = MenuItem.objects.create(caption='menu_item3', parent=menu_item1)
+        menu_item4 = MenuItem.objects.create(caption='menu_item4', parent=menu.root_item)
+
+        def get_change_form():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/test_treemenus_admin/treemenus/menu/%s/' % menu.pk)
+            self.assertEqual(response.status_code, 200)
+            return response, len(queries)
+
+        response, query_count = get_change_form()
+        rows = [(item.caption, item.sibling_count, item.is_first, item.is_last) for item in response.context['menu_items']]
+        self.assertEqual(rows, [
+            ('root', 0, True, True),
+            ('menu_item1', 1, True, False),
+            ('menu_item2', 1, True, False),
+            ('menu_item3', 1, False, True),
+            ('menu_item4', 1, False, True),
+        ])
+        self.assertContains(response, 'items/%s/move_down/' % menu_item2.pk)
+        self.assertNotContains(response, 'items/%s/move_up/' % menu_item2.pk)
+        self.assertContains(response, 'items/%s/move_up/' % menu_item3.pk)
+        self.assertNotContains(response, 'items/%s/move_down/' % menu_item3.pk)
+
+        # The number of queries doesn't depend on the number of items
+        query_count = get_change_form()[1]  # Without the queries of the first request, e.g. for content types
+        for i in range(20):
+            MenuItem.objects.create(caption='child', parent=MenuItem.objects.get(pk=menu_item2.pk))
+        self.assertEqual(get_change_form()[1], query_count)
+
+    def test_get_parent_choices(self):
+        menu = Menu.objects.create(name='menu_get_parent_choices')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu_item1)
+        menu_item3 = MenuItem.objects.create(caption='menu_item3', parent=menu_item2)
+        menu_item4 = MenuItem.objects.create(caption='menu_item4', parent=menu.root_item)
+
+        menu = Menu.objects.get(pk=menu.pk)
+        with self.assertNumQueries(1):
+            choices = get_parent_choices(menu)
+        self.assertEqual(choices, [
+            (menu.root_item.pk, 'root'),
+            (menu_item1.pk, '&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;|-&nbsp;menu_item1'),
+            (menu_item2.pk, '&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;|-&nbsp;menu_item2'),
+            (menu_item3.pk, '&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;|-&nbsp;menu_item3'),
+            (menu_item4.pk, '&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;|-&nbsp;menu_item4'),
+        ])
+
+        # The given item and its descendants are left out
+        with self.assertNumQueries(1):
+            choices = get_parent_choices(menu, menu_item2)
+        self.assertEqual([pk for pk, caption in choices], [menu.root_item.pk, menu_item1.pk, menu_item4.pk])
+
+        # The add and change item pages cost the same number of queries whatever the size of the menu
+        def count_queries(url):
+            self.client.get(url)  # Leave out the queries of the first request, e.g. for content types
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            return len(queries)
+
+        add_url = '/test_treemenus_admin/treemenus/menu/%s/items/add/' % menu.pk
+        change_url = '/test_treemenus_admin/treemenus/menu/%s/items/%s/' % (menu.pk, menu_item4.pk)
+        query_counts = (count_queries(add_url), count_queries(change_url))
+        for i in range(20):
+            MenuItem.objects.create(caption='child', parent=MenuItem.objects.get(pk=menu_item3.pk))
+        self.assertEqual((count_queries(add_url), count_queries(change_url)), query_counts)
+
+    def test_menu_item_choice_field(self):
+        menu = Menu.objects.create(name='menu_item_choice_field')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        other_menu = Menu.objects.create(name='menu_item_choice_field_other')
+
+        field = MenuItemChoiceField(items=get_parent_choice_items(menu))
+        self.assertEqual(field.choices, get_parent_choices(menu))
+        with self.assertNumQueries(0):
+            menu_item = field.clean(str(menu_item1.pk))
+        self.assertEqual(menu_item, menu_item1)
+        self.assertEqual(menu_item.level, 1)
+        for value in ('', '999999', 'abc', str(other_menu.root_item.pk)):
+            self.assertRaises(ValidationError, field.clean, value)
+
+        # Bogus parents are reported as form errors by the admin
+        response = self.client.post('/test_treemenus_admin/treemenus/menu/%s/items/add/' % menu.pk,
+                                    {'parent': other_menu.root_item.pk, 'caption': 'blah'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['adminform'].form.errors['parent'])
+        self.assertEqual(MenuItem.objects.filter(caption='blah').count(), 0)
+
+    def test_move_item_single_update(self):
+        menu = Menu.objects.create(name='menu_move_item_single_update')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu.root_item)
+        menu_item3 = MenuItem.objects.create(caption='menu_item3', parent=menu_item1)
+        for i in range(20):
+            MenuItem.objects.create(caption='child', parent=menu_item2)
+
+        with CaptureQueriesContext(connection) as queries:
+            move_item(menu_item2, -1)
+        updates = [query for query in queries.captured_queries if 'UPDATE' in query['sql']]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual((menu_item2.rank, menu_item2.path), (0, '0000.0000'))
+        self.assertEqual(MenuItem.objects.get(pk=menu_item1.pk).rank, 1)
+        self.assertEqual(MenuItem.objects.get(pk=menu_item3.pk).path, '0000.0001.0000')
+        self.assertEqual(list(MenuItem.objects.filter(caption='child').values_list('path', flat=True).distinct()[:1]), ['0000.0000.0000'])
+        self.assertEqual(MenuItem.objects.filter(path__startswith='0000.0000.', menu=menu).count(), 20)
+
+        # Moving past the edges is reported without touching the ranks
+        self.client.get('/test_treemenus_admin/treemenus/menu/%s/' % menu.pk)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/test_treemenus_admin/treemenus/menu/%s/items/%s/move_up/' % (menu.pk, menu_item2.pk))
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse([query for query in queries.captured_queries if 'UPDATE' in query['sql']])
+        self.assertEqual(MenuItem.objects.get(pk=menu_item2.pk).rank, 0)
+        response = self.client.get('/test_treemenus_admin/treemenus/menu/%s/items/%s/move_down/' % (menu.pk, menu_item2.pk))
+        self.assertEqual(MenuItem.objects.get(pk=menu_item2.pk).rank, 1)
+        self.assertEqual(MenuItem.objects.get(pk=menu_item1.pk).rank, 0)
+
+        # Gaps in the ranks, e.g. left by queryset deletes, are skipped over
+        menu_item4 = MenuItem.objects.create(caption='menu_item4', parent=menu.root_item)
+        MenuItem.objects.filter(pk=menu_item2.pk).delete()
+        self.assertEqual(list(MenuItem.objects.filter(parent=menu.root_item).order_by('rank').values_list('rank', flat=True)), [0, 2])
+        self.client.get('/test_treemenus_admin/treemenus/menu/%s/items/%s/move_up/' % (menu.pk, menu_item4.pk))
+        self.assertEqual(MenuItem.objects.get(pk=menu_item4.pk).path, '0000.0000')
+        self.assertEqual(MenuItem.objects.get(pk=menu_item1.pk).path, '0000.0002')
+        self.assertEqual(MenuItem.objects.get(pk=menu_item3.pk).path, '0000.0002.0000')
+        self.assertRaises(MenuItem.DoesNotExist, move_item, MenuItem.objects.get(pk=menu_item1.pk), 1)
+
+    def test_view_reorder_items(self):
+        menu = Menu.objects.create(name='menu_reorder_items')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu.root_item)
+        menu_item3 = MenuItem.objects.create(caption='menu_item3', parent=menu_item1)
+        menu_item4 = MenuItem.objects.create(caption='menu_item4', parent=menu_item3)
+        other_menu = Menu.objects.create(name='menu_reorder_items_other')
+        url = '/test_treemenus_admin/treemenus/menu/%s/items/reorder/' % menu.pk
+
+        def post(entries):
+            return self.client.post(url, json.dumps(entries), content_type='application/json')
+
+        def structure():
+            return dict((caption, (parent and MenuItem.objects.get(pk=parent).caption, rank, level, path))
+                        for caption, parent, rank, level, path
+                        in MenuItem.objects.filter(menu=menu).values_list('caption', 'parent', 'rank', 'level', 'path'))
+
+        # The change form posts the CSRF token it was rendered with
+        response = self.client.get('/test_treemenus_admin/treemenus/menu/%s/' % menu.pk)
+        self.assertContains(response, "request.setRequestHeader('X-CSRFToken', '%s');" % self.client.cookies[settings.CSRF_COOKIE_NAME].value)
+
+        initial_structure = structure()
+        self.assertEqual(self.client.get(url).status_code, 405)
+        self.assertEqual(self.client.post(url, 'blah', content_type='application/json').status_code, 400)
+        # Cross-menu moves and cycles are rejected, leaving the menu untouched
+        response = post([{'id': menu_item1.pk, 'parent': other_menu.root_item.pk, 'rank': 0}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(json.loads(response.content.decode('utf-8'))['errors']), 1)
+        self.assertEqual(post([{'id': menu_item1.pk, 'parent': menu_item4.pk, 'rank': 0}]).status_code, 400)
+        self.assertEqual(post([{'id': menu.root_item.pk, 'parent': menu_item1.pk, 'rank': 0}]).status_code, 400)
+        self.assertEqual(structure(), initial_structure)
+
+        # Moves are applied with a single UPDATE
+        entries = [
+            {'id': menu.root_item.pk, 'parent': None, 'rank': 0},
+            {'id': menu_item2.pk, 'parent': menu.root_item.pk, 'rank': 0},
+            {'id': menu_item3.pk, 'parent': menu.root_item.pk, 'rank': 1},
+            {'id': menu_item1.pk, 'parent': menu_item2.pk, 'rank': 0},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = post(entries)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([query for query in queries.captured_queries if 'UPDATE' in query['sql']]), 1)
+        self.assertEqual(structure(), {
+            'root': (None, 0, 0, '0000'),
+            'menu_item2': ('root', 0, 1, '0000.0000'),
+            'menu_item1': ('menu_item2', 0, 2, '0000.0000.0000'),
+            'menu_item3': ('root', 1, 1, '0000.0001'),
+            'menu_item4': ('menu_item3', 0, 2, '0000.0001.0000'),
+        })
+        self.assertEqual([item.caption for item in menu.get_tree().get_flattened()],
+                         ['root', 'menu_item2', 'menu_item1', 'menu_item3', 'menu_item4'])
+
+    def test_export_import_commands(self):
+        menu = Menu.objects.create(name='menu_export')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', url='/1/', parent=menu.root_item)
+        MenuItem.objects.create(caption='menu_item2', named_url='admin:index', parent=menu_item1)
+        MenuItem.objects.create(caption='menu_item3', parent=menu_item1)
+        MenuItem.objects.create(caption='menu_item4', parent=menu.root_item)
+
+        def structure(menu_name):
+            return [(item.caption, item.url, item.named_url, item.level, item.rank, item.path)
+                    for item in MenuItem.objects.filter(menu__name=menu_name).exclude(parent=None).order_by('path')]
+
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        for format in ('json', 'jsonl'):
+            output = StringIO()
+            call_command('treemenus_export', 'menu_export', format=format, stdout=output)
+            exported = output.getvalue().replace('"menu_export"', '"menu_import"')
+            file_name = os.path.join(temp_dir, 'menus.%s' % format)
+            with open(file_name, 'w') as f:
+                f.write(exported)
+
+            # Items are inserted level by level, whatever their number
+            with CaptureQueriesContext(connection) as queries:
+                call_command('treemenus_import', file_name, verbosity=0)
+            self.assertEqual(structure('menu_import'), structure('menu_export'))
+            inserts = [query for query in queries.captured_queries if 'INSERT INTO "treemenus_menuitem"' in query['sql']]
+            self.assertEqual(len(inserts), 3 if format == 'json' else 2)  # The first import also creates the root item
+
+        # Merging adds the missing items and updates the matching ones
+        MenuItem.objects.get(caption='menu_item4', menu__name='menu_import').delete()
+        MenuItem.objects.filter(caption='menu_item2', menu__name='menu_import').update(named_url='')
+        MenuItem.objects.create(caption='menu_item5', parent=Menu.objects.get(name='menu_import').root_item)
+        call_command('treemenus_import', file_name, mode='merge', verbosity=0)
+        self.assertEqual([item[:3] for item in structure('menu_import')], [
+            ('menu_item1', '/1/', ''),
+            ('menu_item2', '', 'admin:index'),
+            ('menu_item3', '', ''),
+            ('menu_item5', '', ''),
+            ('menu_item4', '', ''),
+        ])
+        self.assertEqual(Menu.objects.filter(name='menu_import').count(), 1)
+
+    def test_menu_clone(self):
+        from treemenus.tests.fake_menu_extension.models import FakeMenuItemExtension
+        menu = Menu.objects.create(name='menu_clone')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', url='/1/', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', named_url='admin:index', parent=menu_item1)
+        MenuItem.objects.create(caption='menu_item3', parent=menu_item2)
+        MenuItem.objects.create(caption='menu_item4', parent=menu.root_item)
+        FakeMenuItemExtension.objects.create(menu_item=menu_item2, published=True)
+
+        def structure(menu):
+            return [(item.caption, item.url, item.named_url, item.level, item.rank, item.path)
+                    for item in MenuItem.objects.filter(menu=menu).order_by('path')]
+
+        with CaptureQueriesContext(connection) as queries:
+            clone = menu.clone('menu_clone_copy')
+        inserts = [query for query in queries.captured_queries if 'INSERT INTO' in query['sql']]
+        self.assertEqual(len(inserts), 6)  # Menu, root item, 3 levels of items and the extensions
+        self.assertEqual(structure(clone), structure(menu))
+        self.assertEqual(Menu.objects.get(pk=clone.pk).root_item_id, clone.root_item_id)
+        clone_item2 = MenuItem.objects.get(menu=clone, caption='menu_item2')
+        self.assertTrue(FakeMenuItemExtension.objects.get(menu_item=clone_item2).published)
+        self.assertEqual(FakeMenuItemExtension.objects.get(menu_item=menu_item2).menu_item_id, menu_item2.pk)
+        self.assertEqual(FakeMenuItemExtension.objects.count(), 2)
+        self.assertEqual(menu.clone('menu_clone_no_extensions', extensions=False).name, 'menu_clone_no_extensions')
+        self.assertEqual(FakeMenuItemExtension.objects.count(), 2)
+
+        # Admin action
+        response = self.client.post('/test_treemenus_admin/treemenus/menu/', {
+            'action': 'clone_menus', '_selected_action': [menu.pk]})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(structure(Menu.objects.get(name='menu_clone (copy)')), structure(menu))
+
+    def test_extensions_loaded_with_tree(self):
+        from treemenus.tests.fake_menu_extension.models import FakeMenuItemExtension
+        get_shared_cache().clear()
+        menu = Menu.objects.create(name='menu_extensions')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        MenuItem.objects.create(caption='menu_item2', parent=menu.root_item)
+        FakeMenuItemExtension.objects.create(menu_item=menu_item1, published=True)
+
+        def check_extensions(root_item):
+            menu_item1, menu_item2 = root_item.children()
+            self.assertTrue(menu_item1.fakemenuitemextension_related.published)
+            self.assertEqual(menu_item1.fakemenuitemextension_related.menu_item, menu_item1)
+            self.assertRaises(FakeMenuItemExtension.DoesNotExist, getattr, menu_item2, 'fakemenuitemextension_related')
+
+        with self.assertNumQueries(1):
+            check_extensions(menu.get_tree())
+        with override_settings(TREEMENUS_CACHE='shared'):
+            get_menu_tree(Menu.objects.get(pk=menu.pk))
+            with self.assertNumQueries(0):
+                check_extensions(get_menu_tree(Menu(pk=menu.pk)).root_item)
+
+        with override_settings(TREEMENUS_EXTENSIONS=[]):
+            root_item = menu.get_tree()
+        with self.assertNumQueries(1):
+            self.assertTrue(root_item.children()[0].fakemenuitemextension_related.published)
+
+        # Changing or deleting an extension invalidates the cached trees
+        with override_settings(TREEMENUS_CACHE='shared'):
+            extension = FakeMenuItemExtension.objects.get(menu_item=menu_item1)
+            extension.published = False
+            extension.save()
+            root_item = get_menu_tree(menu).root_item
+            self.assertFalse(root_item.children()[0].fakemenuitemextension_related.published)
+            extension.delete()
+            root_item = get_menu_tree(menu).root_item
+            self.assertRaises(FakeMenuItemExtension.DoesNotExist, getattr, root_item.children()[0], 'fakemenuitemextension_related')
+
+    def test_filtered_trees(self):
+        from treemenus.tests.fake_menu_extension.models import FakeMenuItemExtension
+        local_cache.clear()
+        menu = Menu.objects.create(name='menu_filtered_trees')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu_item1)
+        menu_item3 = MenuItem.objects.create(caption='menu_item3', parent=menu.root_item)
+        menu_item4 = MenuItem.objects.create(caption='menu_item4', parent=menu_item3)
+        for menu_item in (menu_item1, menu_item2, menu_item4):
+            FakeMenuItemExtension.objects.create(menu_item=menu_item, published=True)
+
+        # Unpublished items are left out along with their whole subtree
+        root_item = menu.get_tree({'fakemenuitemextension_related__published': True})
+        self.assertEqual([item.caption for item in root_item.get_flattened()], ['root', 'menu_item1', 'menu_item2'])
+
+        t = template.Template('{% load tree_menu_tags %}{% render_menu "menu_filtered_trees" filter=spec %}')
+        self.assertEqual(t.render(template.Context({'spec': 'fakemenuitemextension_related__published=True'})),
+                         '<ul><li><a href="">menu_item1</a><ul><li><a href="">menu_item2</a></li></ul></li></ul>')
+        register_menu_item_filter('not_menu_item2', ~Q(caption='menu_item2'))
+        self.assertEqual(t.render(template.Context({'spec': 'not_menu_item2'})),
+                         '<ul><li><a href="">menu_item1</a></li><li><a href="">menu_item3</a>'
+                         '<ul><li><a href="">menu_item4</a></li></ul></li></ul>')
+        self.assertEqual(template.Template('{% load tree_menu_tags %}{% show_menu "menu_filtered_trees" "unordered-list" filter="caption=\'menu_item3\'" %}')
+                         .render(template.Context()).count('<li>'), 1)
+
+        # Filtered trees are cached separately
+        with override_settings(TREEMENUS_CACHE='local'):
+            filtered_menu = get_menu_tree(Menu.objects.get(pk=menu.pk), 'not_menu_item2')
+            whole_menu = get_menu_tree(Menu.objects.get(pk=menu.pk))
+            with self.assertNumQueries(0):
+                self.assertEqual(get_menu_tree(Menu(pk=menu.pk), 'not_menu_item2'), filtered_menu)
+                self.assertEqual(get_menu_tree(Menu(pk=menu.pk)), whole_menu)
+            self.assertEqual(len(list(filtered_menu.root_item.get_flattened())), 4)
+            self.assertEqual(len(list(whole_menu.root_item.get_flattened())), 5)
+
+        # Unpublishing an item hides it from the cached filtered trees and fragments
+        templates = [template.Template('{%% load tree_menu_tags %%}{%% %s filter="fakemenuitemextension_related__published=True" %%}' % tag)
+                     for tag in ('render_menu "menu_filtered_trees"', 'show_menu "menu_filtered_trees" "unordered-list"')]
+        for cache_settings in ({'TREEMENUS_CACHE': 'shared'}, {'TREEMENUS_CACHE': 'local', 'TREEMENUS_FRAGMENT_CACHE': True}):
+            with override_settings(**cache_settings):
+                get_shared_cache().clear()
+                extension = FakeMenuItemExtension.objects.get(menu_item=menu_item2)
+                extension.published = True
+                extension.save()
+                for t in templates:
+                    self.assertTrue('menu_item2' in t.render(template.Context()))
+                extension.published = False
+                extension.save()
+                for t in templates:
+                    html = t.render(template.Context())
+                    self.assertTrue('menu_item1' in html)
+                    self.assertFalse('menu_item2' in html)
+
+    def test_recursive_queries(self):
+        self.assertTrue(uses_recursive_queries())
+        menu = Menu.objects.create(name='menu_recursive_queries')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu.root_item)
+        menu_item3 = MenuItem.objects.create(caption='menu_item3', parent=menu_item1)
+        menu_item4 = MenuItem.objects.create(caption='menu_item4', parent=menu_item3)
+        menu_item5 = MenuItem.objects.create(caption='menu_item5', parent=menu_item1)
+        for i in range(10):  # Ranks with more digits must still sort numerically
+            MenuItem.objects.create(caption='menu_item5_%s' % i, parent=menu_item5)
+        # The parent links are enough, neither the menu nor the path need to be set
+        MenuItem.objects.filter(menu=menu).update(menu=None, path='')
+
+        expected = ['menu_item1', 'menu_item3', 'menu_item4', 'menu_item5'] + ['menu_item5_%s' % i for i in range(10)]
+        with self.assertNumQueries(1):
+            subtree = list(get_subtree(menu_item1))
+        self.assertEqual([item.caption for item in subtree], expected)
+        self.assertEqual([item.depth for item in subtree][:4], [0, 1, 2, 1])
+        menu_item1 = MenuItem.objects.get(pk=menu_item1.pk)
+        with self.assertNumQueries(1):
+            flattened = list(menu_item1.get_flattened())
+        self.assertEqual([item.caption for item in flattened], expected)
+        self.assertEqual(flattened[1].parent, flattened[0])
+        self.assertEqual([item.caption for item in Menu.objects.get(pk=menu.pk).get_tree().get_flattened()],
+                         ['root'] + expected + ['menu_item2'])
+
+        # Subtree operations only fetch the subtree
+        call_command('treemenus_rebuild', verbosity=0)
+        with CaptureQueriesContext(connection) as queries:
+            update_descendants(MenuItem.objects.get(pk=menu_item3.pk))
+        self.assertEqual(len([query for query in queries.captured_queries if 'RECURSIVE' in query['sql']]), 1)
+
+        with override_settings(TREEMENUS_RECURSIVE_QUERIES=False):
+            self.assertFalse(uses_recursive_queries())
+            with CaptureQueriesContext(connection) as queries:
+                flattened = list(MenuItem.objects.get(pk=menu_item1.pk).get_flattened())
+            self.assertEqual([item.caption for item in flattened], expected)  # Paths were rebuilt above
+            self.assertFalse([query for query in queries.captured_queries if 'RECURSIVE' in query['sql']])
+
+    def test_menu_always_inherited(self):
+        menu = Menu.objects.create(name='menu_inherited')
+        other_menu = Menu.objects.create(name='menu_inherited_other')
+        menu_item1 = MenuItem(caption='menu_item1', parent=menu.root_item)
+        menu_item1.menu = other_menu
+        menu_item1.save()
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu_item1)
+        self.assertEqual((menu_item1.menu_id, menu_item2.menu_id), (menu.pk, menu.pk))
+
+        # Moving to another menu takes the whole subtree along
+        menu_item1.parent = other_menu.root_item
+        menu_item1.save()
+        self.assertEqual(list(MenuItem.objects.filter(caption__startswith='menu_item').values_list('menu', flat=True).distinct()), [other_menu.pk])
+
+        # Menus are backfilled for items saved by older versions
+        MenuItem.objects.all().update(menu=None)
+        call_command('treemenus_rebuild', verbosity=0)
+        self.assertEqual(MenuItem.objects.filter(menu=other_menu).count(), 3)
+        self.assertEqual(MenuItem.objects.get(pk=menu.root_item_id).menu_id, menu.pk)
+        self.assertFalse(MenuItem.objects.filter(menu__isnull=True).exists())
+        with override_settings(TREEMENUS_RECURSIVE_QUERIES=False):
+            MenuItem.objects.all().update(menu=None)
+            call_command('treemenus_rebuild', verbosity=0)
+            self.assertEqual([item.caption for item in other_menu.get_tree().get_flattened()], ['root', 'menu_item1', 'menu_item2'])
+
+    @override_settings(TREEMENUS_RECURSIVE_QUERIES=False)
+    def test_menu_change_without_recursive_queries(self):
+        menu = Menu.objects.create(name='menu_change')
+        other_menu = Menu.objects.create(name='menu_change_other')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', parent=menu_item1)
+        MenuItem.objects.create(caption='menu_item3', parent=menu_item2)
+        MenuItem.objects.create(caption='other_item', parent=other_menu.root_item)
+
+        # The descendants are found in the old menu, and follow the item to the new one
+        menu_item1.parent = other_menu.root_item
+        menu_item1.save()
+        self.assertEqual(list(MenuItem.objects.filter(caption__startswith='menu_item').values_list('menu', flat=True).distinct()), [other_menu.pk])
+        self.assertEqual([(item.caption, item.level) for item in other_menu.get_tree().get_flattened()],
+                         [('root', 0), ('other_item', 1), ('menu_item1', 1), ('menu_item2', 2), ('menu_item3', 3)])
+        self.assertEqual([item.caption for item in menu.get_tree().get_flattened()], ['root'])
+
+    def test_menu_lookup_by_name(self):
+        menu = Menu.objects.create(name='menu_lookup')
+        MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        with transaction.atomic():
+            self.assertRaises(IntegrityError, Menu.objects.create, name='menu_lookup')
+
+        # Without shared stamps, changes made by other processes are seen right away
+        self.assertEqual(get_menu_by_name('menu_lookup').root_item_id, menu.root_item_id)
+        Menu.objects.filter(pk=menu.pk).update(name='menu_lookup_elsewhere')  # No signal is sent
+        self.assertRaises(Menu.DoesNotExist, get_menu_by_name, 'menu_lookup')
+        Menu.objects.filter(pk=menu.pk).update(name='menu_lookup')
+
+        with override_settings(TREEMENUS_CACHE='shared'):
+            get_shared_cache().clear()
+            self.assertEqual(get_menu_by_name('menu_lookup').root_item_id, menu.root_item_id)
+            with self.assertNumQueries(0):
+                looked_up_menu = get_menu_by_name('menu_lookup')
+            self.assertEqual((looked_up_menu.pk, looked_up_menu.name), (menu.pk, 'menu_lookup'))
+
+            # Renaming or deleting menus invalidates the names
+            menu.name = 'menu_lookup_renamed'
+            menu.save()
+            self.assertRaises(Menu.DoesNotExist, get_menu_by_name, 'menu_lookup')
+            self.assertEqual(get_menu_by_name('menu_lookup_renamed').pk, menu.pk)
+            Menu.objects.get(pk=menu.pk).delete()
+            self.assertRaises(Menu.DoesNotExist, get_menu_by_name, 'menu_lookup_renamed')
+
+        # Cloned menus get names of their own
+        menu = Menu.objects.create(name='menu_lookup')
+        for i in range(2):
+            self.client.post('/test_treemenus_admin/treemenus/menu/', {'action': 'clone_menus', '_selected_action': [menu.pk]})
+        self.assertEqual(sorted(Menu.objects.filter(name__startswith='menu_lookup').values_list('name', flat=True)),
+                         ['menu_lookup', 'menu_lookup (copy 2)', 'menu_lookup (copy)'])
+
+    def test_load_menus(self):
+        local_cache.clear()
+        for name in ('menu_header', 'menu_footer', 'menu_sidebar'):
+            menu = Menu.objects.create(name=name)
+            menu_item1 = MenuItem.objects.create(caption='%s_item1' % name, parent=menu.root_item)
+            MenuItem.objects.create(caption='%s_item2' % name, parent=menu_item1)
+
+        # Names and trees are loaded in one query each, however many menus there are
+        t = template.Template('{% load tree_menu_tags %}{% load_menus "menu_header" "menu_footer" "menu_sidebar" "menu_unknown" as menus %}'
+                              '{{ menus.menu_footer.root_item.children.0.caption }}'
+                              '{% show_menu "menu_header" "unordered-list" %}{% render_menu "menu_sidebar" %}')
+        with self.assertNumQueries(2):
+            output = t.render(template.Context())
+        self.assertTrue(output.startswith('menu_footer_item1'))
+        self.assertEqual(output.count('menu_header_item2'), 1)
+        self.assertTrue('<ul><li><a href="">menu_sidebar_item1</a><ul><li><a href="">menu_sidebar_item2</a></li></ul></li></ul>' in output)
+
+        # Filtered trees are only reused by tags using the same filter
+        t = template.Template('{% load tree_menu_tags %}{% load_menus "menu_header" filter="level=1" as menus %}'
+                              '{% render_menu "menu_header" filter="level=1" %}{% render_menu "menu_header" %}')
+        with self.assertNumQueries(4):
+            self.assertEqual(t.render(template.Context()).count('menu_header_item2'), 1)
+        self.assertRaises(template.TemplateSyntaxError, template.Template, '{% load tree_menu_tags %}{% load_menus "menu_header" %}')
+
+        with override_settings(TREEMENUS_CACHE='shared'):
+            get_shared_cache().clear()
+            self.assertEqual(sorted(get_named_menu_trees(['menu_header', 'menu_footer'])), ['menu_footer', 'menu_header'])
+            with self.assertNumQueries(0):
+                menus = get_named_menu_trees(['menu_header', 'menu_footer'])
+            self.assertEqual([item.caption for item in menus['menu_footer'].root_item.get_flattened()],
+                             ['root', 'menu_footer_item1', 'menu_footer_item2'])
+
+    def test_active_items_and_breadcrumbs(self):
+        local_cache.clear()
+        menu = Menu.objects.create(name='menu_active')
+        menu_item1 = MenuItem.objects.create(caption='menu_item1', url='/news/', parent=menu.root_item)
+        menu_item2 = MenuItem.objects.create(caption='menu_item2', url='/news/2013/?page=1', parent=menu_item1)
+        menu_item3 = MenuItem.objects.create(caption='menu_item3', named_url='admin:index', parent=menu_item2)
+        menu_item4 = MenuItem.objects.create(caption='menu_item4', url='/', parent=menu.root_item)
+
+        menu = get_menu_tree(Menu.objects.get(pk=menu.pk))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_active_item(menu, '/news/2013').pk, menu_item2.pk)
+            self.assertEqual(get_active_item(menu, '/test_treemenus_admin/').pk, menu_item3.pk)
+            self.assertEqual(get_active_item(menu, '/news/2014/01/').pk, menu_item1.pk)  # Closest parent URL
+            self.assertEqual(get_active_item(menu, '/').pk, menu_item4.pk)
+            self.assertEqual(get_active_item(menu, '/contact/'), None)
+            self.assertEqual([item.caption for item in get_breadcrumbs(menu, '/test_treemenus_admin/?q=1')],
+                             ['menu_item1', 'menu_item2', 'menu_item3'])
+            self.assertEqual(get_breadcrumbs(menu, '/contact/'), [])
+
+        # The active state only lasts while the menu is being rendered
+        previous_state = set_active_item(get_active_item(menu, '/news/2013/'))
+        try:
+            flags = [(item.caption, item.is_active, item.is_ancestor_of_active) for item in menu.root_item.get_flattened()][1:]
+            self.assertEqual(flags, [('menu_item1', False, True), ('menu_item2', True, False),
+                                     ('menu_item3', False, False), ('menu_item4', False, False)])
+        finally:
+            set_active_item(*previous_state)
+        self.assertFalse(menu_item1.is_ancestor_of_active)
+
+        with override_settings(TREEMENUS_CACHE='both'):
+            get_shared_cache().clear()
+            get_menu_tree(get_menu_by_name('menu_active'))
+            t = template.Template('{% load tree_menu_tags %}{% render_menu "menu_active" %}|{% menu_breadcrumbs "menu_active" %}')
+            request = RequestFactory().get('/news/2013/')
+            with self.assertNumQueries(0):
+                output = t.render(template.Context({'request': request}))
+            self.assertEqual(output, '<ul><li class="ancestor"><a href="/news/">menu_item1</a><ul><li class="active"><a href="/news/2013/?page=1">menu_item2</a>'
+                                     '<ul><li><a href="/test_treemenus_admin/">menu_item3</a></li></ul></li></ul></li><li><a href="/">menu_item4</a></li></ul>|'
+                                     '<ol><li><a href="/news/">menu_item1</a></li><li><a href="/news/2013/?page=1">menu_item2</a></li></ol>')
+            t = template.Template('{% load tree_menu_tags %}{% menu_breadcrumbs "menu_active" url="/" as crumbs %}{{ crumbs|join:"," }}'
+                                  '{% show_menu "menu_active" "unordered-list" url="/news/" %}')
+            output = t.render(template.Context())
+            self.assertTrue(output.startswith('menu_item4'))
+            self.assertEqual(output.count('<li class="active">'), 1)
+
+    def test_menu_windows(self):
+        local_cache.clear()
+        menu = Menu.objects.create(name='menu_windows')
+        menu_item_a = MenuItem.objects.create(caption='a', url='/a/', parent=menu.root_item)
+        menu_item_a1 = MenuItem.objects.create(caption='a1', url='/a/1/', parent=menu_item_a)
+        menu_item_a11 = MenuItem.objects.create(caption='a11', url='/a/1/1/', parent=menu_item_a1)
+        MenuItem.objects.create(caption='a111', url='/a/1/1/1/', parent=menu_item_a11)
+        menu_item_b = MenuItem.objects.create(caption='b', url='/b/', parent=menu.root_item)
+        MenuItem.objects.create(caption='b1', url='/b/1/', parent=menu_item_b)
+
+        def captions(window_menu):
+            return [item.caption for item in window_menu.root_item.get_flattened()]
+
+        # Only the items in the window are fetched
+        self.assertEqual(captions(get_menu_window(menu, max_depth=1)), ['root', 'a', 'b'])
+        self.assertEqual(captions(get_menu_window(menu, max_depth=1, active_path=menu_item_a11.path, expand=True)),
+                         ['root', 'a', 'a1', 'a11', 'a111', 'b'])
+        self.assertEqual(captions(get_menu_window(menu, start_level=2, max_depth=1, active_path=menu_item_a11.path)), ['root', 'a', 'a1'])
+        self.assertEqual(get_menu_window(menu, start_level=3, active_path=menu_item_a.path), None)
+
+        t = template.Template('{% load tree_menu_tags %}{% render_menu "menu_windows" max_depth=1 %}')
+        with self.assertNumQueries(2):
+            self.assertEqual(t.render(template.Context()), '<ul><li><a href="/a/">a</a></li><li><a href="/b/">b</a></li></ul>')
+        t = template.Template('{% load tree_menu_tags %}{% render_menu "menu_windows" max_depth=1 expand="active" %}')
+        with self.assertNumQueries(3):
+            output = t.render(template.Context({'request': RequestFactory().get('/a/1/1/')}))
+        self.assertEqual(output, '<ul><li class="ancestor"><a href="/a/">a</a><ul><li class="ancestor"><a href="/a/1/">a1</a>'
+                                 '<ul><li class="active"><a href="/a/1/1/">a11</a><ul><li><a href="/a/1/1/1/">a111</a></li></ul>'
+                                 '</li></ul></li></ul></li><li><a href="/b/">b</a></li></ul>')
+        t = template.Template('{% load tree_menu_tags %}{% render_menu "menu_windows" start_level=2 max_depth=1 url=url %}')
+        self.assertEqual(t.render(template.Context({'url': '/a/1/1/1/'})), '<ul><li class="ancestor"><a href="/a/1/">a1</a></li></ul>')
+        self.assertEqual(t.render(template.Context({'url': '/b/1/'})), '<ul><li class="active"><a href="/b/1/">b1</a></li></ul>')
+        self.assertEqual(t.render(template.Context()), '')
+        self.assertEqual(template.Template('{% load tree_menu_tags %}{% show_menu "menu_windows" "unordered-list" start_level=2 url="/a/" %}')
+                         .render(template.Context()).count('<li'), 3)
+        for arguments in ('expand="all"', 'start_level="two"', 'max_depth=depth', 'max_depth=0'):
+            self.assertRaises(template.TemplateSyntaxError, template.Template('{%% load tree_menu_tags %%}{%% render_menu "menu_windows" %s %%}' % arguments)
+                              .render, template.Context({'depth': 'deep'}))
+
+        # Windows are cached separately for each active path
+        with override_settings(TREEMENUS_CACHE='both'):
+            get_shared_cache().clear()
+            t = template.Template('{% load tree_menu_tags %}{% show_menu "menu_windows" "unordered-list" max_depth=1 expand="active" url=url %}')
+            html = t.render(template.Context({'url': '/b/1/'}))
+            with self.assertNumQueries(0):
+                self.assertEqual(t.render(template.Context({'url': '/b/1/'})), html)
+            self.assertEqual(html.count('<li'), 3)
+            self.assertEqual(t.render(template.Context({'url': '/a/1/'})).count('<li'), 4)
+
+        # Without caching, only the items that can match the URL are read
+        MenuItem.objects.create(caption='c', named_url='admin:index', parent=menu.root_item)
+        MenuItem.objects.create(caption='d', url='/a/1/?page=2', parent=menu.root_item)
+        self.assertEqual(sorted(get_url_paths(menu, '/a/1/1/?q=1').items()),
+                         [('/a', menu_item_a.path), ('/a/1', menu_item_a1.path), ('/a/1/1', menu_item_a11.path)])
+        self.assertEqual(list(get_url_paths(menu, '/test_treemenus_admin/')), ['/test_treemenus_admin'])
+        self.assertEqual(get_active_path(menu, '/b/2/'), menu_item_b.path)
+
+    def test_path_limits(self):
+        self.assertEqual(get_child_path('0000', PATH_MAX_RANK), '0000.9999')
+        self.assertRaises(ValidationError, get_child_path, '0000', PATH_MAX_RANK + 1)
+
+        menu = Menu.objects.create(name='menu_path_limits')
+        menu_item = menu.root_item
+        for level in range(PATH_MAX_LEVEL):
+            menu_item = MenuItem.objects.create(caption='level%d' % (level + 1), parent=menu_item)
+        self.assertEqual(menu_item.level, PATH_MAX_LEVEL)
+        self.assertEqual(len(menu_item.path), MenuItem._meta.get_field('path').max_length - 1)
+        # Deeper items are rejected with a clear error rather than truncated paths
+        too_deep = MenuItem(caption='too deep', parent=menu_item)
+        self.assertRaises(ValidationError, too_deep.full_clean)
+        self.assertRaises(ValidationError, too_deep.save)
+        self.assertEqual(MenuItem.objects.filter(caption='too deep').count(), 0)
+
+    def test_import_one_menu_at_a_time(self):
+        from treemenus.management.commands.treemenus_import import Command
+        self.addCleanup(setattr, Command, 'read_size', Command.read_size)
+        Command.read_size = 7  # Menus span several reads
+
+        menu = Menu.objects.create(name='menu_import1')
+        for caption in ('old1', 'old2', 'old3'):
+            MenuItem.objects.create(caption=caption, parent=menu.root_item)
+        data = [{'name': 'menu_import1', 'items': [{'caption': 'a', 'url': '/a/', 'children': [{'caption': 'a1', 'children': []}]}]},
+                {'name': 'menu_import2', 'items': [{'caption': 'b', 'named_url': 'admin:index', 'children': []}]}]
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        file_name = os.path.join(temp_dir, 'menus.json')
+
+        def import_menus(content, **options):
+            with open(file_name, 'w') as f:
+                f.write(content)
+            call_command('treemenus_import', file_name, verbosity=0, **options)
+
+        def captions(menu_name):
+            return [(item.caption, item.level) for item in Menu.objects.get(name=menu_name).get_tree().get_flattened()]
+
+        # Replacing the items of a menu invalidates it once, not once per deleted item, and only
+        # once the whole import is over
+        versions = []
+        import_menu = Command.import_menu
+        self.addCleanup(setattr, Command, 'import_menu', import_menu)
+
+        def import_menu_and_check_version(self, *args):
+            import_menu(self, *args)
+            versions.append(get_menu_version(menu.pk, shared=False))
+        Command.import_menu = import_menu_and_check_version
+        version = get_menu_version(menu.pk, shared=False)
+        import_menus(' [\n%s ,\n%s\n] \n' % tuple(json.dumps(menu_data) for menu_data in data))
+        self.assertEqual(versions, [version, version])
+        self.assertEqual(get_menu_version(menu.pk, shared=False), (version[0], version[1] + 1))
+        self.assertEqual(captions('menu_import1'), [('root', 0), ('a', 1), ('a1', 2)])
+        self.assertEqual(captions('menu_import2'), [('root', 0), ('b', 1)])
+        import_menus('[]')
+        self.assertEqual(Menu.objects.filter(name__startswith='menu_import').count(), 2)
+
+        # Nothing is imported from invalid data, even when the first menus could be read
+        for content in ('{}', '[%s' % json.dumps(data[0]), '[%s]' % json.dumps(data[0])[:-1], '[%s %s]' % (json.dumps(data[0]), json.dumps(data[1]))):
+            self.assertRaises(CommandError, import_menus, content.replace('"a"', '"x"'))
+        self.assertEqual(captions('menu_import1'), [('root', 0), ('a', 1), ('a1', 2)])
+
+        # A menu's items are expected on consecutive lines
+        lines = ['{"menu": "menu_import1", "path": "0000", "caption": "c"}', '{"menu": "menu_import2", "path": "0000", "caption": "d"}']
+        import_menus('\n'.join(lines), format='jsonl')
+        self.assertEqual(captions('menu_import1'), [('root', 0), ('c', 1)])
+        self.assertRaises(CommandError, import_menus, '\n'.join(lines + lines[:1]), format='jsonl')
+
+    def test_admin_invalidates_after_commit(self):
+        menu = Menu.objects.create(name='menu_admin_invalidation')
+        menu_item = MenuItem.objects.create(caption='menu_item1', parent=menu.root_item)
+        versions = []
+
+        def record_version(sender, instance, **kwargs):
+            versions.append(get_menu_version(menu.pk, shared=False))
+        post_save.connect(record_version, sender=MenuItem)
+        self.addCleanup(post_save.disconnect, record_version, sender=MenuItem)
+
+        # The admin's views run in a transaction: the menu is only invalidated once it is over
+        version = get_menu_version(menu.pk, shared=False)
+        response = self.client.post('/test_treemenus_admin/treemenus/menu/%s/items/%s/' % (menu.pk, menu_item.pk),
+                                    {'parent': menu.root_item.pk, 'caption': 'menu_item1 changed', 'url': '/1/'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(versions, [version])
+        self.assertEqual(get_menu_version(menu.pk, shared=False), (version[0], version[1] + 1))
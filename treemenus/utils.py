@@ -1,24 +1,107 @@
+import weakref
+try:
+    from urllib.parse import urlparse
+except ImportError:  # Python 2
+    from urlparse import urlparse
+
+import django
+from django.conf import settings
+from django.core.urlresolvers import get_resolver, get_script_prefix, get_urlconf, resolve, reverse, NoReverseMatch, Resolver404
 from django.utils.safestring import mark_safe
-from django.forms import ChoiceField
+from django.utils.translation import get_language, ugettext as _
+from django.forms import ChoiceField, ValidationError
+from django.db import connections, models, router, transaction
+from django.db.models import Max, Q
+try:
+    from django.db.transaction import atomic
+except ImportError:  # Django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+
+from treemenus.models import Menu, MenuItem, PATH_SEPARATOR, get_child_path
+from treemenus.cache import get_cache_tiers, get_menu_url_paths, invalidate_menu
+
 
-from treemenus.models import MenuItem
+# Maximum number of parameters passed to a single statement, to stay clear of the limits
+# imposed by some databases (e.g. 999 on SQLite).
+MAX_QUERY_PARAMS = 900
+
+# Fields holding the content of menu items, as opposed to their place in the tree
+MENU_ITEM_DATA_FIELDS = ('caption', 'url', 'named_url')
 
 
 class MenuItemChoiceField(ChoiceField):
-    ''' Custom field to display the list of items in a tree manner '''
+    ''' Custom field to display the list of items in a tree manner.
+        If given the 'items' to choose from (e.g. from get_parent_choice_items()), the choices are
+        built from them and the chosen item is returned without hitting the database.
+    '''
+    def __init__(self, *args, **kwargs):
+        items = kwargs.pop('items', None)
+        if items is not None:
+            items = list(items)
+            kwargs.setdefault('choices', [(item.pk, mark_safe(item.caption_with_spacer())) for item in items])
+            self.items = dict((item.pk, item) for item in items)
+        else:
+            self.items = None
+        super(MenuItemChoiceField, self).__init__(*args, **kwargs)
+
     def clean(self, value):
-        return MenuItem.objects.get(pk=value)
+        value = super(MenuItemChoiceField, self).clean(value)  # Checks that the value is one of the choices
+        if value in ('', None):
+            return None
+        try:
+            if self.items is not None:
+                return self.items[int(value)]
+            return MenuItem.objects.get(pk=value)
+        except (KeyError, ValueError, TypeError, MenuItem.DoesNotExist):
+            raise ValidationError(self.error_messages['invalid_choice'] % {'value': value})
 
 
 def move_item(menu_item, vector):
-    ''' Helper function to move and item up or down in the database '''
-    old_rank = menu_item.rank
-    swapping_sibling = MenuItem.objects.get(parent=menu_item.parent, rank=old_rank + vector)
-    new_rank = swapping_sibling.rank
-    swapping_sibling.rank = old_rank
-    menu_item.rank = new_rank
-    menu_item.save()
-    swapping_sibling.save()
+    ''' Helper function to move and item up or down in the database.
+        Swaps the ranks of the item and of the sibling 'vector' places away in rank order (and the
+        paths of both their subtrees) with a single UPDATE statement, inside a transaction holding
+        a lock on the siblings. Gaps in the ranks are skipped over, e.g. moving up an item ranked 3
+        swaps it with the one ranked 1 if none is ranked 2. Raises MenuItem.DoesNotExist if there
+        is no such sibling.
+    '''
+    atomic(_move_item)(menu_item, vector)
+    invalidate_menu(menu_item.menu_id)
+
+
+def _move_item(menu_item, vector):
+    siblings = MenuItem.objects.filter(parent=menu_item.parent_id)
+    if hasattr(siblings, 'select_for_update'):  # Django >= 1.4
+        siblings = siblings.select_for_update()
+    ranks = dict((pk, (rank, path)) for pk, rank, path in siblings.values_list('pk', 'rank', 'path'))
+    old_rank, old_path = ranks.pop(menu_item.pk, (menu_item.rank, menu_item.path))
+    if vector < 0:
+        candidates = sorted(((rank, pk) for pk, (rank, path) in ranks.items() if rank < old_rank), reverse=True)
+    else:
+        candidates = sorted((rank, pk) for pk, (rank, path) in ranks.items() if rank > old_rank)
+    if len(candidates) < abs(vector):
+        raise MenuItem.DoesNotExist('There is no item %s places away from "%s".' % (vector, menu_item))
+    new_rank, swapping_pk = candidates[abs(vector) - 1]
+    new_path = ranks[swapping_pk][1]
+
+    values = {
+        menu_item.pk: (new_rank, new_path),
+        swapping_pk: (old_rank, old_path),
+    }
+    if old_path and new_path:
+        # Swap the beginning of the paths of both subtrees
+        descendants = MenuItem.objects.filter(menu=menu_item.menu_id).filter(
+            Q(path__startswith=old_path + PATH_SEPARATOR) | Q(path__startswith=new_path + PATH_SEPARATOR))
+        for pk, rank, path in descendants.values_list('pk', 'rank', 'path'):
+            if path.startswith(old_path + PATH_SEPARATOR):
+                values[pk] = (rank, new_path + path[len(old_path):])
+            else:
+                values[pk] = (rank, old_path + path[len(new_path):])
+        update_menu_items(('rank', 'path'), values)
+    else:  # Paths haven't been computed yet, e.g. for items saved by older versions
+        update_menu_items(('rank', 'path'), values)
+        update_descendants(MenuItem.objects.get(pk=menu_item.parent_id))
+    menu_item.rank, menu_item.path = new_rank, new_path
+    menu_item._original_structure = (menu_item.parent_id, menu_item.level, menu_item.path)
 
 
 def move_item_or_clean_ranks(menu_item, vector):
@@ -35,30 +118,654 @@ def move_item_or_clean_ranks(menu_item, vector):
             move_item(fresh_menu_item, vector)
 
 
+def get_parent_choice_items(menu, menu_item=None):
+    """
+    Returns the items of the menu that can be chosen as the parent of 'menu_item', in display order.
+    If 'menu_item' is not given or None, returns every item of the menu. If given, intentionally omit it and its descendant in the list.
+    The menu's items are all fetched with a single query.
+    """
+    root_item = menu.get_tree()
+    excepted_pk = menu_item.pk if menu_item is not None else None
+    items = []
+    pending = [root_item] if root_item is not None else []
+    while pending:
+        item = pending.pop()
+        if excepted_pk is not None and item.pk == excepted_pk:
+            continue  # Skip the item and, by not visiting its children, all its descendants
+        items.append(item)
+        pending.extend(reversed(item.children()))
+    return items
+
+
 def get_parent_choices(menu, menu_item=None):
     """
     Returns flat list of tuples (possible_parent.pk, possible_parent.caption_with_spacer).
     If 'menu_item' is not given or None, returns every item of the menu. If given, intentionally omit it and its descendant in the list.
     """
-    def get_flat_tuples(menu_item, excepted_item=None):
-        if menu_item == excepted_item:
-            return []
-        else:
-            choices = [(menu_item.pk, mark_safe(menu_item.caption_with_spacer()))]
-            if menu_item.has_children():
-                for child in menu_item.children():
-                    choices += get_flat_tuples(child, excepted_item)
-            return choices
-
-    return get_flat_tuples(menu.root_item, menu_item)
+    return [(item.pk, mark_safe(item.caption_with_spacer())) for item in get_parent_choice_items(menu, menu_item)]
 
 
 def clean_ranks(menu_items):
     """
     Resets ranks from 0 to n, n being the number of items.
+    The new ranks are written with a single UPDATE statement, without going through MenuItem.save(),
+    and the paths of the items and of their descendants are then refreshed accordingly.
     """
-    rank = 0
-    for menu_item in menu_items:
+    menu_items = list(menu_items)
+    if not menu_items:
+        return
+    ranks = {}
+    for rank, menu_item in enumerate(menu_items):
         menu_item.rank = rank
-        menu_item.save()
-        rank += 1
+        ranks[menu_item.pk] = (rank,)
+    atomic(_clean_ranks)(menu_items, ranks)
+    for menu_pk in set(menu_item.menu_id for menu_item in menu_items):
+        invalidate_menu(menu_pk)
+
+
+def _clean_ranks(menu_items, ranks):
+    update_menu_items(('rank',), ranks)
+    if menu_items[0].parent_id is not None:
+        update_descendants(menu_items[0].parent)
+    else:  # Root items
+        for menu_item in menu_items:
+            update_descendants(menu_item)
+
+
+def reorder_menu_items(menu, entries):
+    """
+    Applies a new arrangement of the given menu's items, described by 'entries': a list of
+    {'id': ..., 'parent': ..., 'rank': ...} dicts. Items that aren't listed keep their parent,
+    and the ranks of each set of siblings are then renumbered from 0 following the given ones.
+    Raises ValidationError if an entry refers to an item of another menu or if the new parents
+    would create a cycle. Otherwise the parents, ranks, levels and paths that changed are written
+    with a single UPDATE statement, in a transaction.
+    """
+    atomic(_reorder_menu_items)(menu, entries)
+    invalidate_menu(menu.pk)
+
+
+def _reorder_menu_items(menu, entries):
+    menu_items = MenuItem.objects.filter(menu=menu)
+    if hasattr(menu_items, 'select_for_update'):  # Django >= 1.4
+        menu_items = menu_items.select_for_update()
+    current_values = {}
+    parents = {}
+    ranks = {}
+    for pk, parent_pk, rank, level, path in menu_items.values_list('pk', 'parent', 'rank', 'level', 'path'):
+        current_values[pk] = (parent_pk, rank, level, path)
+        parents[pk] = parent_pk
+        ranks[pk] = (rank, rank)
+
+    if not isinstance(entries, (list, tuple)):
+        raise ValidationError(_('A list of menu items is expected.'))
+    errors = []
+    for entry in entries:
+        try:
+            pk, parent_pk, rank = int(entry['id']), int(entry['parent']), int(entry['rank'])
+        except (KeyError, TypeError, ValueError):
+            if isinstance(entry, dict) and entry.get('id') == menu.root_item_id and entry.get('parent') is None:
+                continue  # The root item staying where it is
+            errors.append(_('Invalid menu item entry: %r.') % (entry,))
+            continue
+        if pk not in parents or parent_pk not in parents:
+            errors.append(_('The menu item %(id)s or its parent %(parent)s is not part of this menu.') % entry)
+        elif pk == menu.root_item_id:
+            errors.append(_('The root item cannot be moved.'))
+        else:
+            parents[pk] = parent_pk
+            ranks[pk] = (rank, ranks[pk][1])
+    if errors:
+        raise ValidationError(errors)
+
+    children = {}
+    for pk in sorted(parents, key=ranks.get):
+        children.setdefault(parents[pk], []).append(pk)
+    root_parent, root_rank, root_level, root_path = current_values[menu.root_item_id]
+    new_values = {menu.root_item_id: current_values[menu.root_item_id]}
+    pending = [(menu.root_item_id, root_level, root_path)]
+    while pending:
+        parent_pk, level, path = pending.pop()
+        for rank, pk in enumerate(children.get(parent_pk, ())):
+            child_path = get_child_path(path, rank)
+            new_values[pk] = (parent_pk, rank, level + 1, child_path)
+            pending.append((pk, level + 1, child_path))
+    if len(new_values) < len(current_values):
+        # Items that can't be reached from the root item are part of a cycle
+        raise ValidationError(_('A menu item cannot be moved under one of its own descendants.'))
+    update_menu_items(('parent', 'rank', 'level', 'path'), dict(
+        (pk, values) for pk, values in new_values.items() if values != current_values[pk]))
+
+
+# Maximum depth walked by recursive queries, so that corrupted parent links can't loop forever
+MAX_RECURSION_DEPTH = 255
+
+SUBTREE_CTE = (
+    'WITH RECURSIVE treemenus_subtree (id, depth, tree_path) AS ('
+    'SELECT %(pk)s, 0, %(root_segment)s FROM %(table)s WHERE %(pk)s IN (%(roots)s) '
+    'UNION ALL '
+    'SELECT child.%(pk)s, treemenus_subtree.depth + 1, treemenus_subtree.tree_path || \'.\' || %(child_segment)s '
+    'FROM %(table)s child INNER JOIN treemenus_subtree ON child.%(parent)s = treemenus_subtree.id '
+    'WHERE treemenus_subtree.depth < %(max_depth)s)'
+)
+
+# Zero-padded rank, so that the paths built by the recursive queries sort in display order
+RANK_SEGMENTS = {
+    'sqlite': "substr('0000000000' || %s, -10, 10)",
+    'postgresql': "lpad(CAST(%s AS TEXT), 10, '0')",
+}
+
+
+def uses_recursive_queries(connection=None):
+    """
+    Returns True if subtrees are loaded with recursive (WITH RECURSIVE) queries, which
+    PostgreSQL and SQLite >= 3.8.3 support, unless the TREEMENUS_RECURSIVE_QUERIES setting
+    is False. Otherwise, they are fetched by menu or by path.
+    """
+    if not getattr(settings, 'TREEMENUS_RECURSIVE_QUERIES', True):
+        return False
+    connection = connection or connections[router.db_for_read(MenuItem)]
+    vendor = getattr(connection, 'vendor', None)
+    if vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 8, 3)
+    return vendor == 'postgresql'
+
+
+def _get_subtree_cte(connection, root_count=1):
+    qn = connection.ops.quote_name
+    rank_segment = RANK_SEGMENTS[connection.vendor]
+    rank_column = qn(MenuItem._meta.get_field('rank').column)
+    return SUBTREE_CTE % {
+        'pk': qn(MenuItem._meta.pk.column),
+        'parent': qn(MenuItem._meta.get_field('parent').column),
+        'table': qn(MenuItem._meta.db_table),
+        'root_segment': rank_segment % rank_column,
+        'child_segment': rank_segment % ('child.%s' % rank_column),
+        'max_depth': MAX_RECURSION_DEPTH,
+        'roots': ', '.join(['%s'] * root_count),
+    }
+
+
+def get_subtree(menu_item):
+    """
+    Returns the given item (a fresh copy of it) and all its descendants, in display order,
+    with a single recursive query following the parent links. Each item gets a 'depth'
+    (relative to the given item) and a 'tree_path' attribute, its path of zero-padded ranks.
+    Only works if uses_recursive_queries() returns True.
+    """
+    connection = connections[router.db_for_read(MenuItem)]
+    qn = connection.ops.quote_name
+    sql = '%s SELECT item.*, treemenus_subtree.depth, treemenus_subtree.tree_path FROM %s item ' \
+          'INNER JOIN treemenus_subtree ON item.%s = treemenus_subtree.id ' \
+          'ORDER BY treemenus_subtree.tree_path, item.%s' % (
+              _get_subtree_cte(connection), qn(MenuItem._meta.db_table), qn(MenuItem._meta.pk.column), qn(MenuItem._meta.pk.column))
+    return MenuItem.objects.db_manager(connection.alias).raw(sql, [getattr(menu_item, 'pk', menu_item)])
+
+
+def filter_subtree(queryset, menu_items):
+    """
+    Restricts the given queryset of menu items to the given item (or item pk), or list of
+    items, and their descendants, with a recursive subquery. Only works if
+    uses_recursive_queries() returns True.
+    """
+    if not isinstance(menu_items, (list, tuple)):
+        menu_items = [menu_items]
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    where = '%s.%s IN (%s SELECT id FROM treemenus_subtree)' % (
+        qn(MenuItem._meta.db_table), qn(MenuItem._meta.pk.column), _get_subtree_cte(connection, len(menu_items)))
+    return queryset.extra(where=[where], params=[getattr(menu_item, 'pk', menu_item) for menu_item in menu_items])
+
+
+def update_descendants(menu_item, old_menu_id=None):
+    """
+    Recomputes the level and path of all the descendants of the given item (as saved in the
+    database) from their parents and ranks, sets their menu to the item's, and writes those that
+    changed. This takes a single query to fetch the structure of the item's subtree (or of its
+    whole menu, and of 'old_menu_id' if it was just moved from another menu, if recursive queries
+    aren't supported), and one UPDATE statement.
+    """
+    if uses_recursive_queries():
+        candidates = filter_subtree(MenuItem.objects.all(), menu_item)
+    elif menu_item.menu_id is not None:
+        # Items saved by older versions may not have their menu set yet, so those are considered too.
+        menu_pks = [menu_pk for menu_pk in (menu_item.menu_id, old_menu_id) if menu_pk is not None]
+        candidates = MenuItem.objects.filter(Q(menu__in=menu_pks) | Q(menu__isnull=True))
+    else:
+        candidates = MenuItem.objects.all()
+    children = {}
+    current_values = {}
+    for pk, parent_pk, rank, level, path, menu_pk in candidates.values_list('pk', 'parent', 'rank', 'level', 'path', 'menu'):
+        children.setdefault(parent_pk, []).append((pk, rank))
+        current_values[pk] = (level, path, menu_pk)
+    if menu_item.pk not in current_values:
+        return
+
+    new_values = {}
+    pending = [(menu_item.pk,) + current_values[menu_item.pk][:2]]
+    while pending:
+        pk, level, path = pending.pop()
+        for child_pk, rank in children.get(pk, ()):
+            if child_pk in new_values:
+                continue
+            values = (level + 1, get_child_path(path, rank))
+            new_values[child_pk] = values + (menu_item.menu_id or current_values[child_pk][2],)
+            pending.append((child_pk,) + values)
+    changed_values = dict((pk, values) for pk, values in new_values.items() if values != current_values[pk])
+    if any(values[2] != current_values[pk][2] for pk, values in changed_values.items()):
+        update_menu_items(('level', 'path', 'menu'), changed_values)
+    else:
+        update_menu_items(('level', 'path'), changed_values)
+
+
+def bulk_create_menu_items(nodes):
+    """
+    Creates the trees of menu items described by 'nodes', a list of (menu_item, children) pairs,
+    'children' being again such a list. The top-level items must have their (already saved)
+    parent set, and are ranked after its existing children. The ranks, levels and paths are
+    computed up front, and the items are then inserted level by level with bulk_create(): it
+    takes two queries per level (the insert, then fetching the new primary keys by path),
+    whatever the number of items. Returns the created items, with their pk set.
+    """
+    nodes = list(nodes)
+    if not nodes:
+        return []
+    created = atomic(_bulk_create_menu_items)(nodes)
+    for menu_pk in set(menu_item.menu_id for menu_item in created):
+        invalidate_menu(menu_pk)
+    return created
+
+
+def _bulk_create_menu_items(nodes):
+    next_ranks = {}
+    max_ranks = MenuItem.objects.filter(parent__in=set(menu_item.parent_id for menu_item, children in nodes))
+    for row in max_ranks.values('parent').annotate(max_rank=Max('rank')):
+        next_ranks[row['parent']] = row['max_rank'] + 1
+    for menu_item, children in nodes:
+        menu_item.rank = next_ranks.get(menu_item.parent_id, 0)
+        next_ranks[menu_item.parent_id] = menu_item.rank + 1
+
+    created = []
+    while nodes:
+        menu_items = [menu_item for menu_item, children in nodes]
+        for menu_item in menu_items:
+            menu_item.menu_id = menu_item.parent.menu_id
+            menu_item.level = menu_item.parent.level + 1
+            menu_item.path = menu_item.get_path()
+        _insert_menu_items(menu_items)
+        created.extend(menu_items)
+
+        next_nodes = []
+        for menu_item, children in nodes:
+            for rank, (child, grandchildren) in enumerate(children):
+                child.parent = menu_item
+                child.rank = rank
+                next_nodes.append((child, grandchildren))
+        nodes = next_nodes
+    return created
+
+
+def _insert_menu_items(menu_items):
+    if not hasattr(MenuItem.objects, 'bulk_create'):  # Django < 1.4
+        for menu_item in menu_items:
+            models.Model.save(menu_item, force_insert=True)  # Skips MenuItem.save(), values are already computed
+    else:
+        MenuItem.objects.bulk_create(menu_items)
+        # Paths are unique within a menu, so they tell which rows were just inserted
+        by_path = dict(((menu_item.menu_id, menu_item.path), menu_item) for menu_item in menu_items)
+        menu_pks = set(menu_item.menu_id for menu_item in menu_items)
+        paths = list(set(menu_item.path for menu_item in menu_items))
+        batch_size = MAX_QUERY_PARAMS - len(menu_pks)
+        for start in range(0, len(paths), batch_size):
+            rows = MenuItem.objects.filter(menu__in=menu_pks, path__in=paths[start:start + batch_size])
+            for menu_pk, path, pk in rows.values_list('menu', 'path', 'pk'):
+                if (menu_pk, path) in by_path:
+                    by_path[(menu_pk, path)].pk = pk
+    for menu_item in menu_items:
+        menu_item._state.adding = False
+        menu_item._original_structure = (menu_item.parent_id, menu_item.level, menu_item.path)
+
+
+def get_menu_item_extensions():
+    """
+    Returns the models extending menu items, i.e. those with a one-to-one 'menu_item' link
+    to MenuItem (see the "Customizing/Extending" section of the README).
+    """
+    return [related.model for related in get_menu_item_extension_relations()]
+
+
+def get_menu_item_extension_relations():
+    """
+    Returns the reverse relations from MenuItem to its extension models. Those are all the
+    models with a one-to-one 'menu_item' link to MenuItem, unless the TREEMENUS_EXTENSIONS
+    setting restricts them to a list of 'app_label.ModelName' names.
+    """
+    relations = [related for related in MenuItem._meta.get_all_related_objects()
+                 if isinstance(related.field, models.OneToOneField) and related.field.name == 'menu_item']
+    model_names = getattr(settings, 'TREEMENUS_EXTENSIONS', None)
+    if model_names is not None:
+        model_names = set(model_name.lower() for model_name in model_names)
+        relations = [related for related in relations
+                     if ('%s.%s' % (related.model._meta.app_label, related.model._meta.object_name)).lower() in model_names]
+    return relations
+
+
+def set_menu_item_extensions(menu_items, related, extensions):
+    """
+    Links the given extension objects (of the model of the 'related' relation) to the given
+    menu items, as if they had been accessed through the relation. Items that have none are
+    marked as such, so that the relation raises DoesNotExist without querying the database.
+    """
+    extensions = dict((extension.menu_item_id, extension) for extension in extensions)
+    for menu_item in menu_items:
+        extension = extensions.get(menu_item.pk)
+        setattr(menu_item, related.get_cache_name(), extension)
+        if extension is not None:
+            setattr(extension, related.field.get_cache_name(), menu_item)
+
+
+def clone_menu(menu, name, extensions=True):
+    """
+    Creates a copy of the given menu named 'name', with copies of all its items, and of
+    their extension objects unless 'extensions' is False. The items are created with
+    bulk_create_menu_items() and the extension objects with one bulk insert per model,
+    in a single transaction. Returns the new menu.
+    """
+    return atomic(_clone_menu)(menu, name, extensions)
+
+
+def _clone_menu(menu, name, extensions):
+    root_item = menu.get_tree()
+    new_menu = Menu.objects.create(name=name)
+    copies = {root_item.pk: new_menu.root_item}
+    nodes = []
+    pending = [(child, nodes) for child in reversed(root_item.children())]
+    while pending:
+        menu_item, siblings = pending.pop()
+        copy = MenuItem(**dict((field_name, getattr(menu_item, field_name)) for field_name in MENU_ITEM_DATA_FIELDS))
+        copy.parent = copies[menu_item.parent_id]
+        copies[menu_item.pk] = copy
+        children = []
+        siblings.append((copy, children))
+        pending.extend((child, children) for child in reversed(menu_item.children()))
+    bulk_create_menu_items(nodes)
+
+    if extensions:
+        menu_item_pks = [pk for pk in copies if pk != root_item.pk]
+        for model in get_menu_item_extensions():
+            extension_copies = []
+            for start in range(0, len(menu_item_pks), MAX_QUERY_PARAMS):
+                for extension in model._default_manager.filter(menu_item__in=menu_item_pks[start:start + MAX_QUERY_PARAMS]):
+                    copy = copies[extension.menu_item_id]
+                    extension.pk = None  # Also clears the link when it is the primary key
+                    extension.menu_item_id = copy.pk
+                    extension_copies.append(extension)
+            if hasattr(model._default_manager, 'bulk_create'):
+                model._default_manager.bulk_create(extension_copies)
+            else:  # Django < 1.4
+                for extension in extension_copies:
+                    extension.save(force_insert=True)
+    return new_menu
+
+
+def update_menu_items(field_names, values):
+    """
+    Sets the given fields of menu items to values[pk] (a tuple with a value for each field)
+    for each pk in 'values', with a single UPDATE statement (or one per batch of items on very
+    large updates). Bypasses MenuItem.save(), so the caller is responsible for keeping the tree
+    consistent and invalidating cached menus.
+    """
+    if not values:
+        return
+    connection = connections[router.db_for_write(MenuItem)]
+    qn = connection.ops.quote_name
+    pk_column = qn(MenuItem._meta.pk.column)
+    sql = 'UPDATE %s SET %%s WHERE %s IN (%%s)' % (qn(MenuItem._meta.db_table), pk_column)
+    batch_size = MAX_QUERY_PARAMS // (2 * len(field_names) + 1)
+    cursor = connection.cursor()
+    items = list(values.items())
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        assignments = []
+        params = []
+        for index, field_name in enumerate(field_names):
+            assignments.append('%s = CASE %s %s END' % (
+                qn(MenuItem._meta.get_field(field_name).column), pk_column, ' '.join(['WHEN %s THEN %s'] * len(batch))))
+            for pk, item_values in batch:
+                params.extend([pk, item_values[index]])
+        params.extend([pk for pk, item_values in batch])
+        cursor.execute(sql % (', '.join(assignments), ', '.join(['%s'] * len(batch))), params)
+    if django.VERSION < (1, 6):
+        transaction.set_dirty(using=connection.alias)
+
+
+# Filters registered with register_menu_item_filter(), by name
+_menu_item_filters = {}
+
+
+def register_menu_item_filter(name, item_filter):
+    """
+    Registers a filter (a Q object or a dict of lookups) on menu items, which can then be
+    passed by name to the show_menu and render_menu template tags, or to get_menu_tree().
+    """
+    if isinstance(item_filter, dict):
+        item_filter = Q(**item_filter)
+    _menu_item_filters[name] = item_filter
+
+
+def get_menu_item_filter(spec):
+    """
+    Returns the Q object for the given filter spec: either the name of a registered filter,
+    or comma-separated lookup=value pairs, e.g. "extension__published=True". True, False,
+    None and integer values are converted, other ones are taken as strings.
+    """
+    if spec in _menu_item_filters:
+        return _menu_item_filters[spec]
+    lookups = {}
+    for condition in spec.split(','):
+        lookup, equals, value = condition.partition('=')
+        lookup, value = lookup.strip(), value.strip()
+        if not equals or not lookup:
+            raise ValueError('Invalid menu item filter: "%s".' % spec)
+        if value in ('True', 'False', 'None'):
+            value = {'True': True, 'False': False, 'None': None}[value]
+        elif value.lstrip('-').isdigit():
+            value = int(value)
+        elif len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+            value = value[1:-1]
+        lookups[str(lookup)] = value
+    return Q(**lookups)
+
+
+# Reversed named URLs, per URL resolver and then per (named URL, script prefix, language, current app).
+# Since clear_url_caches() and set_urlconf() lead to other resolvers being used, entries
+# computed for the previous ones simply stop being used and are garbage collected.
+_reversed_named_urls = weakref.WeakKeyDictionary()
+
+
+def resolve_named_url(named_url, current_app=None):
+    """
+    Returns the URL for the given named URL, memoized for the active URLconf, script prefix and
+    language (URLs can be translated, or prefixed with the language by i18n_patterns()).
+    Raises NoReverseMatch if it can't be reversed.
+    """
+    urlconf = get_urlconf()
+    resolver = get_resolver(urlconf)
+    try:
+        memo = _reversed_named_urls[resolver]
+    except KeyError:
+        memo = _reversed_named_urls.setdefault(resolver, {})
+    key = (named_url, get_script_prefix(), get_language(), current_app)
+    try:
+        return memo[key]
+    except KeyError:
+        url = memo[key] = reverse(named_url, urlconf=urlconf, current_app=current_app)
+        return url
+
+
+def resolve_named_urls(menu_items):
+    """
+    Reverses, in one pass, the named URLs of all the given menu items, so that looking them
+    up later (e.g. via MenuItem.resolved_url or the reverse_named_url tag) is a dict lookup.
+    """
+    for menu_item in menu_items:
+        if menu_item.named_url:
+            try:
+                resolve_named_url(menu_item.named_url)
+            except NoReverseMatch:
+                pass
+
+
+def normalize_url(url):
+    """
+    Returns the path of the given URL, without its query string, fragment or trailing slash,
+    e.g. '/news' for both '/news/?page=2' and 'http://example.com/news'.
+    """
+    return urlparse(url).path.rstrip('/') or '/'
+
+
+def get_url_index(menu):
+    """
+    Returns a dictionary of the items of the given menu's loaded tree (see Menu.get_tree()) by
+    normalized URL (see normalize_url()), named URLs being reversed. The first item in display
+    order wins when several have the same URL. The index is built once per tree, URLconf,
+    script prefix and language.
+    """
+    key = (get_urlconf(), get_script_prefix(), get_language())
+    indexes = menu.__dict__.setdefault('_url_indexes', {})
+    try:
+        return indexes[key]
+    except KeyError:
+        pass
+    index = {}
+    if menu.root_item_id is not None:
+        pending = list(reversed(menu.root_item.children()))
+        while pending:
+            menu_item = pending.pop()
+            url = menu_item.resolved_url
+            if url:
+                index.setdefault(normalize_url(url), menu_item)
+            pending.extend(reversed(menu_item.children()))
+    indexes[key] = index
+    return index
+
+
+def get_url_paths(menu, url=None):
+    """
+    Returns a dictionary of the materialized paths of the given menu's items by normalized URL,
+    like get_url_index() but reading only those columns from the database, so that the active
+    branch of a menu can be found without loading its items (see get_menu_url_paths()).
+    If given a URL, only the items that can match it or one of its parent URLs (see lookup_url())
+    are read: those with one of these URLs, possibly followed by a query string or a fragment,
+    and those whose named URL is the name these URLs resolve to. Links to other sites are then
+    left out.
+    """
+    url_paths = {}
+    items = MenuItem.objects.filter(menu=menu.pk).exclude(pk=menu.root_item_id).order_by('path')
+    if url is not None:
+        items = items.filter(_get_url_lookups(url))
+    for path, url, named_url in items.values_list('path', 'url', 'named_url'):
+        if named_url:
+            try:
+                url = resolve_named_url(named_url)
+            except NoReverseMatch:
+                pass
+        if url:
+            url_paths.setdefault(normalize_url(url), path)
+    return url_paths
+
+
+def _get_url_lookups(url):
+    """
+    Returns the lookups matching the menu items that can match the given URL or one of its
+    parent URLs, including the ones with a named URL resolving to one of them.
+    """
+    candidates = []
+    path = normalize_url(url)
+    while True:
+        candidates.extend(path == '/' and [path] or [path, path + '/'])
+        if path.count('/') <= 1:
+            break
+        path = path.rpartition('/')[0]
+
+    script_prefix = get_script_prefix()
+    lookups = Q(url__in=candidates)
+    for candidate in candidates:
+        lookups |= Q(url__startswith=candidate + '?') | Q(url__startswith=candidate + '#')
+        if not candidate.startswith(script_prefix):
+            continue
+        try:
+            match = resolve('/' + candidate[len(script_prefix):])
+        except Resolver404:
+            continue
+        for name in set([getattr(match, 'view_name', None), getattr(match, 'url_name', None)]):  # Django >= 1.3
+            if name:
+                # Named URLs may be followed by arguments, e.g. 'show_profile user.id'
+                lookups |= Q(named_url=name) | Q(named_url__startswith=name + ' ')
+    return lookups
+
+
+def lookup_url(index, url):
+    """
+    Returns the value of the given index (see get_url_index()) for the given URL, or else the
+    one for its closest parent URL (e.g. '/news' for '/news/2013/'), or None. The root URL '/'
+    is only matched by itself.
+    """
+    path = normalize_url(url)
+    value = index.get(path)
+    while value is None and path.count('/') > 1:
+        path = path.rpartition('/')[0]
+        value = index.get(path)
+    return value
+
+
+def get_active_item(menu, url):
+    """
+    Returns the item of the given menu's loaded tree matching the given URL (see lookup_url()),
+    or None.
+    """
+    return lookup_url(get_url_index(menu), url)
+
+
+def get_active_path(menu, url):
+    """
+    Returns the materialized path of the item of the given menu matching the given URL (see
+    lookup_url()), or None, without loading the menu's items. When trees are cached, the paths
+    of all the items are read and cached at once, otherwise only the ones that can match the URL
+    are read (see get_url_paths()).
+    """
+    if any(get_cache_tiers()):
+        return lookup_url(get_menu_url_paths(menu), url)
+    return lookup_url(get_url_paths(menu, url), url)
+
+
+def get_loaded_branch(root_item, path):
+    """
+    Returns the items of the given loaded tree leading to the item whose materialized path is
+    given, from the root item down to that item, or to its deepest ancestor that is loaded.
+    """
+    branch = [root_item]
+    while path and branch[-1].path != path:
+        for child in branch[-1].children():
+            if child.path == path or path.startswith(child.path + PATH_SEPARATOR):
+                branch.append(child)
+                break
+        else:
+            break
+    return branch
+
+
+def get_breadcrumbs(menu, url):
+    """
+    Returns the items leading to the one matching the given URL in the given menu's loaded
+    tree (see get_active_item()), from the first level down to that item, without hitting
+    the database.
+    """
+    breadcrumbs = []
+    menu_item = get_active_item(menu, url)
+    while menu_item is not None and menu_item.parent_id is not None:
+        breadcrumbs.append(menu_item)
+        menu_item = menu_item.parent
+    breadcrumbs.reverse()
+    return breadcrumbs